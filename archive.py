@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import datetime
+import gzip
+import io
+import json
+import logging
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+# имя файла архива, отправляемого пользователю
+ARCHIVE_NAME = 'notes_{0}_{1:%Y%m%d}.jsonl.gz'
+# максимальный размер файла, который бот может скачать из Telegram
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+# максимальная длина одной строки архива в байтах
+MAX_LINE_BYTES = 64 * 1024
+# число заметок, записываемых в базу одной транзакцией при импорте
+IMPORT_BATCH = 500
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class ArchiveError(ValueError):
+    """
+    Файл архива поврежден или имеет неверный формат.
+    """
+
+
+def write_archive(fileobj, tags, notes):
+    """
+    Записывает архив в двоичный файл fileobj: gzip-сжатый JSONL, одна
+    запись на строку. Сначала идут записи тэгов
+    {"type": "tag", "name", "definition"}, затем записи заметок
+    {"type": "note", "date", "text", "tags"}.
+
+    Записи сериализуются по одной, поэтому notes может быть
+    генератором любой длины. Возвращает число записанных заметок.
+    """
+    count = 0
+    with gzip.GzipFile(filename='', mode='wb', fileobj=fileobj) as archive:
+        for name, definition in tags:
+            archive.write(_dump({
+                'type': 'tag',
+                'name': name,
+                'definition': definition
+            }))
+        for note in notes:
+            archive.write(_dump({
+                'type': 'note',
+                'date': str(note['date']),
+                'text': note['text'],
+                'tags': note['tags']
+            }))
+            count += 1
+    return count
+
+
+def _dump(record):
+    return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def _records(data):
+    # архив может быть прислан и без сжатия
+    if data[:2] == GZIP_MAGIC:
+        stream = gzip.GzipFile(fileobj=io.BytesIO(data))
+    else:
+        stream = io.BytesIO(data)
+    number = 0
+    while True:
+        try:
+            line = stream.readline(MAX_LINE_BYTES + 1)
+        except (OSError, EOFError) as err:
+            raise ArchiveError(u'файл архива поврежден: {0}'.format(err))
+        if not line:
+            break
+        number += 1
+        if len(line) > MAX_LINE_BYTES:
+            raise ArchiveError(u'строка {0} слишком длинная'.format(number))
+        if not line.strip():
+            continue
+        try:
+            record = _parse_record(json.loads(line))
+        except KeyError as err:
+            raise ArchiveError(u'в строке {0} нет поля {1}'.format(number, err))
+        except (ValueError, TypeError) as err:
+            raise ArchiveError(u'ошибка в строке {0}: {1}'.format(number, err))
+        yield record
+
+
+def _parse_record(record):
+    if record['type'] == 'tag':
+        if not isinstance(record['name'], str) or not record['name']:
+            raise ValueError(u'неверное имя тэга')
+        return 'tag', (record['name'], str(record['definition']))
+    if record['type'] == 'note':
+        if not isinstance(record['text'], str):
+            raise ValueError(u'неверный текст заметки')
+        tags = record.get('tags') or []
+        if not all(isinstance(name, str) for name in tags):
+            raise ValueError(u'неверные тэги заметки')
+        return 'note', {
+            'date': datetime.datetime.fromisoformat(record['date']),
+            'text': record['text'],
+            'tags': tags
+        }
+    raise ValueError(u'неизвестный тип записи {0}'.format(record['type']))
+
+
+def read_archive(data):
+    """
+    Разбирает архив, записанный write_archive (содержимое файла data).
+
+    Возвращает список пар (имя, описание) тэгов и генератор заметок,
+    который распаковывает и разбирает архив построчно. Ошибка формата
+    выбрасывает ArchiveError.
+    """
+    records = _records(data)
+    tags = []
+    first_note = None
+    for kind, value in records:
+        if kind == 'tag':
+            tags.append(value)
+        else:
+            first_note = value
+            break
+
+    def notes():
+        if first_note is None:
+            return
+        yield first_note
+        for kind, value in records:
+            if kind == 'tag':
+                raise ArchiveError(u'тэги должны предшествовать заметкам')
+            yield value
+
+    return tags, notes()
+
+
+class Archive:
+    """
+    Команды /export и /import: выгрузка заметок пользователя в файл
+    и загрузка заметок из файла.
+
+    При инициализации принимает экземпляр Telebot (файлы передаются
+    синхронно) и хранилище заметок.
+    Имеет следующие публичные методы:
+    export(user_id) - отправить пользователю архив всех его заметок
+                      одним документом;
+    import_archive(user_id, file_id, file_size, update_id) - записать
+                                                             в базу
+                                                             заметки из
+                                                             присланного
+                                                             файла
+                                                             архива.
+    Оба метода возвращают строку с уведомлением для пользователя.
+
+    Архив записывается во временный файл на диске и отправляется
+    блоками, а при импорте распаковывается построчно, поэтому
+    расход памяти не зависит от числа заметок. Размер импортируемого
+    файла ограничен Telegram (MAX_IMPORT_BYTES). Ключи загруженных
+    заметок выводятся из update_id команды, поэтому повтор того же
+    обновления после сбоя не записывает заметки второй раз.
+    """
+    def __init__(self, bot, conn):
+        self.bot = bot
+        self.conn = conn
+
+    def export(self, user_id):
+        with tempfile.TemporaryFile() as archive:
+            count = write_archive(
+                archive,
+                self.conn.export_tags(user_id),
+                self.conn.export_notes(user_id)
+            )
+            if not count:
+                return u'заметок для выгрузки нет'
+            filename = ARCHIVE_NAME.format(user_id, datetime.date.today())
+            self.bot.send_document(user_id, filename, archive)
+        logger.info(u'user_id:{0}, выгружено заметок: {1}'.format(
+            user_id, count))
+        return u'выгружено заметок: {0}'.format(count)
+
+    def import_archive(self, user_id, file_id=None, file_size=None,
+                       update_id=None):
+        if file_id is None:
+            return u'прикрепите файл архива к сообщению с подписью /import'
+        if file_size is not None and file_size > MAX_IMPORT_BYTES:
+            return u'файл архива больше {0} МБ'.format(
+                MAX_IMPORT_BYTES // (1024 * 1024))
+        data = self.bot.download_file(file_id)
+        if data is None:
+            return u'не удалось скачать файл архива'
+        try:
+            # первый проход проверяет весь архив, чтобы поврежденный
+            # файл не был загружен частично
+            tags, notes = read_archive(data)
+            for _ in notes:
+                pass
+            tags, notes = read_archive(data)
+        except ArchiveError as err:
+            return str(err)
+        self.conn.add_user(user_id, datetime.datetime.now())
+        count = self.conn.import_notes(
+            user_id, tags, notes, IMPORT_BATCH, update_id)
+        logger.info(u'user_id:{0}, загружено заметок: {1}'.format(
+            user_id, count))
+        return u'загружено заметок: {0}'.format(count)
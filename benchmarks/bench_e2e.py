@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+Сквозной бенчмарк бота: цикл start.run (или start_async.run) против
+локальной имитации API Telegram (fake_telegram.FakeTelegramServer)
+и хранилища SqliteStorage.
+
+Имитация API работает в отдельном процессе, чтобы не делить GIL
+с ботом. Ограничения частоты отправки SendQueue отключены: бенчмарк
+измеряет собственную пропускную способность бота.
+Выводит:
+-число команд в секунду (от первой выдачи обновлений до последнего
+ ответа);
+-p50 и p99 задержки от выдачи команды боту до получения ответа;
+-число запросов к базе данных на команду.
+
+Бот останавливается до завершения имитации API, а его журнал
+не выводится в stderr.
+
+Запуск из корня проекта:
+    python benchmarks/bench_e2e.py [число команд] [число пользователей]
+        [sync|async] [частота команд в секунду]
+Без частоты все команды доступны сразу (максимальная нагрузка).
+"""
+import asyncio
+import datetime
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import FakeTelegramServer, make_update  # noqa: E402
+from bot import AsyncTelebot, Telebot  # noqa: E402
+from send_queue import AsyncSendQueue, SendQueue  # noqa: E402
+from sqlite_storage import SqliteStorage  # noqa: E402
+import start  # noqa: E402
+import start_async  # noqa: E402
+
+
+BOT_ID = 'bench'
+# доля команд каждого вида; каждая команда дает ровно один ответ
+COMMANDS = [
+    (u'/write Заметка {0} про #bench и работу', 50),
+    (u'/read_last', 20),
+    (u'/tag bench', 10),
+    (u'/search заметка', 10),
+    (u'/read_all 1', 10)
+]
+# время ожидания всех ответов в секундах
+TIMEOUT = 120
+
+
+def make_updates(count, users, seed=1):
+    generator = random.Random(seed)
+    texts = [text for text, _ in COMMANDS]
+    weights = [weight for _, weight in COMMANDS]
+    updates = []
+    started = set()
+    for number in range(count):
+        user_id = 1000 + number % users
+        if user_id not in started:
+            # первая команда пользователя - запись, чтобы чтение
+            # и поиск всегда возвращали ответ
+            text = texts[0]
+            started.add(user_id)
+        else:
+            text = generator.choices(texts, weights)[0]
+        updates.append(make_update(number + 1, user_id, text.format(number)))
+    return updates
+
+
+def serve(updates, rate, port_pipe, result_pipe, bot_stopped):
+    server = FakeTelegramServer(updates, rate=rate)
+    server.start()
+    port_pipe.send(server.port)
+    server.wait_replies(len(updates), TIMEOUT)
+    result_pipe.send(server.stats())
+    # сервер работает, пока бот не остановлен, иначе бот получил бы
+    # ошибки соединения
+    bot_stopped.wait(TIMEOUT)
+    server.stop()
+
+
+class CountingStorage(SqliteStorage):
+    """
+    SqliteStorage, считающее выполненные SQLite запросы.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.queries = 0
+        self._count_lock = threading.Lock()
+
+    def _count(self, statement):
+        if not statement.startswith('PRAGMA'):
+            with self._count_lock:
+                self.queries += 1
+
+    def _connect(self):
+        cnx = super()._connect()
+        cnx.set_trace_callback(self._count)
+        return cnx
+
+
+def make_storage(path, users):
+    storage = CountingStorage(path)
+    storage.create_tables()
+    storage.migrate()
+    date = datetime.datetime(2021, 1, 1)
+    for number in range(users):
+        storage.add_user(1000 + number, date)
+    storage.write_tag('bench', u'заметки бенчмарка')
+    storage.queries = 0
+    return storage
+
+
+# параметры очереди отправки без ограничений частоты
+UNLIMITED = {
+    'workers': start.SEND_WORKERS,
+    'chat_rate': 1e9,
+    'chat_burst': 1e9,
+    'global_rate': 1e9,
+    'global_burst': 1e9
+}
+
+
+def run_bot(mode, port, storage):
+    """
+    Запускает бота в отдельном потоке и возвращает функцию, которая
+    останавливает его и ждет завершения потока.
+    """
+    api = {'host': '127.0.0.1', 'port': port, 'use_tls': False}
+    if mode == 'async':
+        bot = AsyncTelebot(BOT_ID, poll_timeout=1, auto_commit=False, **api)
+        send_queue = AsyncSendQueue(bot, **UNLIMITED)
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(start_async.run(bot, storage, send_queue))
+
+        def target():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                loop.close()
+
+        def stop():
+            loop.call_soon_threadsafe(task.cancel)
+    else:
+        bot = Telebot(BOT_ID, pool_size=start.SEND_WORKERS + 1,
+                      poll_timeout=1, auto_commit=False, **api)
+        send_queue = SendQueue(bot, **UNLIMITED)
+        stop_event = threading.Event()
+        target = lambda: start.run(bot, storage, send_queue, stop_event)
+        stop = stop_event.set
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+
+    def stop_and_join():
+        stop()
+        thread.join(TIMEOUT)
+    return stop_and_join
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'sync'
+    rate = float(sys.argv[4]) if len(sys.argv) > 4 else None
+    updates = make_updates(count, users)
+    # журнал бота (например, ошибки соединения) не смешивается
+    # с результатами
+    logging.getLogger().addHandler(logging.NullHandler())
+    port_reader, port_writer = multiprocessing.Pipe(duplex=False)
+    result_reader, result_writer = multiprocessing.Pipe(duplex=False)
+    bot_stopped = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve,
+        args=(updates, rate, port_writer, result_writer, bot_stopped),
+        daemon=True)
+    server.start()
+    port = port_reader.recv()
+    with tempfile.TemporaryDirectory() as directory:
+        storage = make_storage(os.path.join(directory, 'bench.db'), users)
+        stop_bot = run_bot(mode, port, storage)
+        stats = result_reader.recv()
+        queries = storage.queries
+        stop_bot()
+        bot_stopped.set()
+        storage.close_connection()
+    server.join()
+    print('режим {0}, {1} команд, {2} пользователей'.format(
+        mode, count, users))
+    if stats['replies'] < count or not stats['latencies']:
+        print('получено только {0} ответов из {1}'.format(
+            stats['replies'], count))
+        sys.exit(1)
+    latencies = stats['latencies']
+    print('{0:<28} {1:10.0f}'.format(
+        'команд в секунду', count / stats['elapsed']))
+    print('{0:<28} {1:10.2f} мс'.format(
+        'задержка p50', percentile(latencies, 0.5) * 1000))
+    print('{0:<28} {1:10.2f} мс'.format(
+        'задержка p99', percentile(latencies, 0.99) * 1000))
+    print('{0:<28} {1:10.2f}'.format(
+        'запросов к базе на команду', queries / count))
+
+
+if __name__ == '__main__':
+    main()
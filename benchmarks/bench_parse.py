@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Микро-бенчмарк разбора обновлений функцией bot.parse_data.
+
+Запуск из корня проекта:
+    python benchmarks/bench_parse.py [число обновлений] [число повторов]
+Выводит скорость разбора в сообщениях в секунду.
+"""
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import logger, parse_data  # noqa: E402
+
+
+TEXTS = [
+    u'/start',
+    u'/write Купить #молоко и #хлеб до вечера',
+    u'/write_tag молоко продукты из магазина',
+    u'/read_last',
+    u'/read 42',
+    u'/read_all 2',
+    u'/read_tag молоко',
+    u'/tag молоко хлеб',
+    u'/tag_all',
+    u'/search молоко',
+    u'просто текст без команды',
+    None,
+    u'/read не_число'
+]
+
+
+def make_updates(count):
+    result = []
+    for update_id in range(count):
+        message = {
+            'message_id': update_id,
+            'from': {'id': 1000 + update_id % 50},
+            'date': 1600000000 + update_id
+        }
+        text = TEXTS[update_id % len(TEXTS)]
+        if text is not None:
+            message['text'] = text
+        result.append({'update_id': update_id, 'message': message})
+    return {'ok': True, 'result': result}
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    # измеряется сам разбор, а не запись журнала на диск; без
+    # обработчика предупреждения о некорректных обновлениях ушли бы
+    # в stderr через logging.lastResort
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.NullHandler())
+    data = make_updates(count)
+    best = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        parse_data(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print('parse_data: {0} обновлений за {1:.4f} с, {2:.0f} сообщений/с'.format(
+        count, best, count / best))
+
+
+if __name__ == '__main__':
+    main()
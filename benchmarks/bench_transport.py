@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк чтения и декодирования ответа getUpdates.
+
+Сравнивает прежний способ (чтение сокета кусками по 512 байт
+с конкатенацией bytes, декодирование в str, поиск статуса регулярным
+выражением и json.loads от среза строки) с transport.HttpConnection
+(буферизованное чтение, recv_into, декодирование JSON из байтов,
+orjson при наличии) на локальном HTTP-сервере без TLS.
+Оба способа работают на одном постоянном (keep-alive) соединении,
+поэтому разница не включает установку соединений (см. ConnectionPool).
+
+Запуск из корня проекта:
+    python benchmarks/bench_transport.py [число обновлений] [число запросов]
+"""
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transport import (  # noqa: E402
+    HttpConnection, build_request, decode_json, orjson
+)
+
+
+def make_payload(count):
+    result = []
+    for update_id in range(count):
+        result.append({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'from': {'id': 1000 + update_id, 'first_name': u'Пользователь'},
+                'chat': {'id': 1000 + update_id, 'type': 'private'},
+                'date': 1600000000 + update_id,
+                'text': u'/write Заметка номер {0} #тэг'.format(update_id) * 3
+            }
+        })
+    return json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+
+def make_handler(payload):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            if self.headers.get('Connection', '').lower() == 'close':
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+
+class LegacyConnection:
+    """
+    Прежний способ чтения ответа на постоянном соединении: вместо
+    чтения до закрытия соединения чтение заканчивается, когда получено
+    Content-Length байт тела.
+    """
+    REQUEST = ('GET /getUpdates HTTP/1.1\r\n'
+               'Host: 127.0.0.1\r\n'
+               'Connection: keep-alive\r\n\r\n').encode('utf-8')
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def request(self):
+        self.sock.send(self.REQUEST)
+        response = b''
+        total = None
+        while total is None or len(response) < total:
+            data = self.sock.recv(512)
+            response += data
+            if total is None:
+                pos = response.find(b'\r\n\r\n')
+                if pos != -1:
+                    length = re.search(
+                        br'Content-Length: (\d+)', response[:pos])
+                    total = pos + 4 + int(length.group(1))
+        http_response = str(response.decode())
+        status = re.match(r'HTTP/1.1 (\d+) (.+)\s', http_response)
+        status.groups()
+        pos = http_response.find('\r\n\r\n')
+        return json.loads(http_response[pos:])
+
+    def close(self):
+        self.sock.close()
+
+
+def run(name, func, requests):
+    started = time.perf_counter()
+    for _ in range(requests):
+        data = func()
+    elapsed = time.perf_counter() - started
+    assert len(data['result']) > 0
+    print('{0:<28} {1:8.2f} мс/запрос'.format(name, elapsed / requests * 1000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    payload = make_payload(count)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(payload))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    legacy = LegacyConnection(port)
+    conn = HttpConnection('127.0.0.1', port, use_tls=False)
+    raw_request = build_request('127.0.0.1', 'GET', '/getUpdates')
+    print('{0} обновлений, {1} байт, orjson: {2}'.format(
+        count, len(payload), 'да' if orjson is not None else 'нет'))
+    run('прежний способ', legacy.request, requests)
+    run('HttpConnection',
+        lambda: decode_json(conn.request(raw_request).body), requests)
+    # тот же разбор стандартным json: вклад только чтения ответа
+    run('HttpConnection, json.loads',
+        lambda: json.loads(conn.request(raw_request).body), requests)
+    legacy.close()
+    conn.close()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк записи заметок: транзакция на каждую заметку
+(StorageBackend.write) против отложенной записи пакетами
+(WriteBuffer / StorageBackend.write_many).
+
+Используется встроенное хранилище SqliteStorage со схемой из
+tables.py, поэтому сервер MySQL не нужен, а выполняются те же
+запросы, что и в боте. Замер повторяется в двух режимах:
+synchronous=FULL (каждая фиксация ждет fsync, как MySQL с
+innodb_flush_log_at_trx_commit=1) и synchronous=NORMAL, с которым
+работает бот на SQLite.
+
+Запуск из корня проекта:
+    python benchmarks/bench_write.py [число заметок] [размер пакета]
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlite_storage import SqliteStorage
+
+
+USERS = 20
+# режимы PRAGMA synchronous, в которых выполняется замер
+SYNCHRONOUS_MODES = ('FULL', 'NORMAL')
+
+
+def make_storage(path, synchronous):
+    storage = SqliteStorage(path)
+    storage.SYNCHRONOUS = synchronous
+    storage.create_tables()
+    storage.migrate()
+    date = datetime.datetime(2021, 1, 1)
+    for user_id in range(USERS):
+        storage.add_user(user_id, date)
+    storage.write_tag('work', u'работа')
+    storage.write_tag('home', u'дом')
+    return storage
+
+
+def make_notes(count):
+    date = datetime.datetime(2021, 1, 1)
+    return [{
+        'date': date,
+        'text': u'Заметка {0} #work #home'.format(number),
+        'user_id': number % USERS,
+        'tags_names': ['work', 'home'],
+        'update_id': number
+    } for number in range(count)]
+
+
+def write_each(storage, notes):
+    for note in notes:
+        storage.write(**note)
+
+
+def write_batched(storage, notes, batch_size):
+    for start in range(0, len(notes), batch_size):
+        storage.write_many(notes[start:start + batch_size])
+
+
+def run(name, func, count, synchronous):
+    with tempfile.TemporaryDirectory() as directory:
+        storage = make_storage(
+            os.path.join(directory, 'bench.db'), synchronous)
+        started = time.perf_counter()
+        func(storage)
+        elapsed = time.perf_counter() - started
+        storage.close_connection()
+    rate = count / elapsed
+    print('{0:<32} {1:10.0f} заметок/с'.format(name, rate))
+    return rate
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    notes = make_notes(count)
+    for synchronous in SYNCHRONOUS_MODES:
+        print('synchronous={0}'.format(synchronous))
+        each = run('транзакция на заметку',
+                   lambda storage: write_each(storage, notes),
+                   count, synchronous)
+        batched = run(
+            'пакеты по {0} заметок'.format(batch_size),
+            lambda storage: write_batched(storage, notes, batch_size),
+            count, synchronous)
+        print('ускорение: {0:.1f}x'.format(batched / each))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Локальный HTTP-сервер, имитирующий API Telegram для бенчмарков
+и нагрузочных тестов.
+
+Отдает методом getUpdates заранее сгенерированный поток обновлений
+и записывает вызовы sendMessage и sendDocument; файлы, добавленные
+методом add_file, отдаются через getFile. Для каждого ответа измеряется
+задержка от выдачи боту обновления с командой до получения ответа
+в тот же чат (ответы одного чата сопоставляются командам по порядку).
+"""
+import collections
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+
+def make_update(update_id, user_id, text, date=1600000000):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': {'id': user_id, 'first_name': u'Пользователь'},
+            'chat': {'id': user_id, 'type': 'private'},
+            'date': date + update_id,
+            'text': text
+        }
+    }
+
+
+def _parse_query(query):
+    # текст ответа может содержать '+', поэтому parse_qs не подходит
+    params = {}
+    for part in query.split('&'):
+        key, _, value = part.partition('=')
+        params[key] = unquote(value)
+    return params
+
+
+def _parse_multipart(body, boundary):
+    # поля формы - строки, файл - пара (имя файла, содержимое)
+    params = {}
+    delimiter = b'--' + boundary.encode('latin-1')
+    for part in body.split(delimiter)[1:-1]:
+        head, _, data = part[2:-2].partition(b'\r\n\r\n')
+        disposition = head.split(b'\r\n')[0].decode('utf-8')
+        fields = dict(
+            item.strip().split('=', 1) for item in disposition.split(';')[1:])
+        name = fields['name'].strip('"')
+        if 'filename' in fields:
+            params[name] = (fields['filename'].strip('"'), data)
+        else:
+            params[name] = data.decode('utf-8')
+    return params
+
+
+class FakeTelegramServer:
+    """
+    Имитация API Telegram.
+
+    При инициализации принимает список обновлений (update_id должны
+    идти подряд начиная с 1), адрес и порт (0 - любой свободный) и
+    частоту появления обновлений rate в секунду; если rate не задан,
+    все обновления доступны сразу.
+    Имеет следующие публичные методы:
+    start() - запустить сервер в фоновом потоке;
+    stop() - остановить сервер;
+    wait_replies(count, timeout) - дождаться count вызовов
+                                   sendMessage; возвращает True, если
+                                   дождались;
+    stats() - вернуть словарь с числом ответов, задержками ответов
+              в секундах и временем от первой выдачи обновлений до
+              последнего ответа;
+    add_file(file_id, data) - сделать файл доступным для скачивания
+                              ботом.
+    Отправленные ботом документы записываются в список documents
+    (id чата, имя файла, содержимое).
+    """
+    def __init__(self, updates, host='127.0.0.1', port=0, rate=None):
+        self.updates = updates
+        self.rate = rate
+        self.sent = []
+        self.documents = []
+        self.files = {}
+        self.latencies = []
+        self.first_delivery = None
+        self.last_reply = None
+        self._delivered = 0
+        self._waiting = collections.defaultdict(collections.deque)
+        self._cond = threading.Condition()
+        self._started = None
+        self.server = ThreadingHTTPServer((host, port), self._request_handler())
+        self.server.daemon_threads = True
+        self.port = self.server.server_port
+
+    def _request_handler(self):
+        fake = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _reply(self, status, body, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path.startswith('/file/'):
+                    data = fake.files.get(url.path.rsplit('/', 1)[-1])
+                    if data is None:
+                        self._reply(404, b'')
+                    else:
+                        self._reply(200, data, 'application/octet-stream')
+                    return
+                method = url.path.rsplit('/', 1)[-1]
+                self._reply(200, fake.call(method, _parse_query(url.query)))
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if self.headers.get_content_type() == 'multipart/form-data':
+                    params = _parse_multipart(
+                        body, self.headers.get_param('boundary'))
+                else:
+                    params = _parse_query(body.decode('ascii'))
+                self._reply(200, fake.call(method, params))
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def call(self, method, params):
+        if method == 'getUpdates':
+            offset = params.get('offset')
+            result = self.get_updates(
+                int(offset) if offset and offset != 'None' else 1,
+                float(params.get('timeout') or 0),
+                int(params.get('limit') or 100)
+            )
+        elif method == 'sendMessage':
+            result = self.send_message(int(params['chat_id']), params['text'])
+        elif method == 'sendDocument':
+            result = self.send_document(
+                int(params['chat_id']), *params['document'])
+        elif method == 'getFile':
+            if params['file_id'] not in self.files:
+                return json.dumps({'ok': False, 'error_code': 400}).encode()
+            result = {
+                'file_id': params['file_id'],
+                'file_path': 'documents/{0}'.format(params['file_id'])
+            }
+        else:
+            result = True
+        return json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+    def _available(self, now):
+        if self.rate is None:
+            return len(self.updates)
+        return min(len(self.updates), int((now - self._started) * self.rate))
+
+    def get_updates(self, offset, timeout, limit):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                available = self._available(now)
+                if offset - 1 < available or now >= deadline:
+                    break
+                wait = deadline - now
+                if self.rate is not None and available < len(self.updates):
+                    wait = min(wait, (available + 1) / self.rate
+                               - (now - self._started))
+                self._cond.wait(max(wait, 0.001))
+            result = self.updates[offset - 1:available][:limit]
+            for update in result:
+                if update['update_id'] <= self._delivered:
+                    continue
+                self._delivered = update['update_id']
+                chat_id = update['message']['chat']['id']
+                self._waiting[chat_id].append(now)
+            if result and self.first_delivery is None:
+                self.first_delivery = now
+        return result
+
+    def send_message(self, chat_id, text):
+        with self._cond:
+            now = time.monotonic()
+            self.sent.append((chat_id, text))
+            waiting = self._waiting[chat_id]
+            if waiting:
+                self.latencies.append(now - waiting.popleft())
+            self.last_reply = now
+            self._cond.notify_all()
+        return {'chat': {'id': chat_id}, 'text': text}
+
+    def send_document(self, chat_id, filename, data):
+        with self._cond:
+            self.documents.append((chat_id, filename, data))
+        return {'chat': {'id': chat_id}, 'document': {'file_name': filename}}
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    def wait_replies(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while len(self.sent) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            elapsed = None
+            if self.first_delivery is not None and self.last_reply is not None:
+                elapsed = self.last_reply - self.first_delivery
+            return {
+                'replies': len(self.sent),
+                'latencies': list(self.latencies),
+                'elapsed': elapsed
+            }
+
+    def start(self):
+        self._started = time.monotonic()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
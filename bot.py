@@ -1,16 +1,18 @@
 # -*- coding: utf-8 -*-
 import datetime
-import json
 import logging
-from logging.handlers import RotatingFileHandler
 import os
 import re
 import socket
-import ssl
-import sys
+import uuid
 
 from dotenv import load_dotenv
 
+from log_config import LOG_MESSAGE_TEXT
+import metrics
+from transport import (AsyncConnectionPool, ConnectionPool, decode_json,
+                       encode_query)
+
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
@@ -18,17 +20,11 @@ if os.path.exists(dotenv_path):
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = RotatingFileHandler(
-    'bot_logs.log',
-    maxBytes=1000000,
-    backupCount=5
-)
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)-12s - %(levelname)s - %(message)s'
-)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+# максимальная длина одного сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+# разделитель строк в тексте ответа
+LINE_SEPARATOR = '\n'
 
 
 class Command():
@@ -39,12 +35,171 @@ class Command():
     user_id - id пользователя, от которогоо поступила команда;
     text - текст команды, определяет действие, которое необходимо 
            совершить;
-    params - параметры команды, которые необходимы для ее совершения.
+    params - параметры команды, которые необходимы для ее совершения;
+    update_id - id обновления Telegram, из которого получена команда.
     """
-    def __init__(self, user_id, text, params):
+    def __init__(self, user_id, text, params, update_id=None):
         self.user_id = user_id
         self.text = text
         self.params = params
+        self.update_id = update_id
+
+
+COMMAND_RE = re.compile(r'\/(\w+)\s?(.*\s?)?')
+HASHTAG_RE = re.compile(r'\#(\S+)')
+
+
+def _parse_page(tail):
+    # номер страницы - необязательный положительный целый параметр
+    if tail and tail.strip().isdigit() and int(tail) > 0:
+        return int(tail)
+    return None
+
+
+def _message_date(update):
+    return datetime.datetime.fromtimestamp(update['message']['date'])
+
+
+def _start_params(user_id, update, tail):
+    return {
+        'user_id': user_id,
+        'date': _message_date(update)
+    }
+
+
+def _write_params(user_id, update, tail):
+    return {
+        'user_id': user_id,
+        'date': _message_date(update),
+        'text': tail,
+        'tags_names': HASHTAG_RE.findall(tail),
+        'update_id': update.get('update_id')
+    }
+
+
+def _write_tag_params(user_id, update, tail):
+    tag_name, tag_definition = tail.split(' ', 1)
+    return {
+        'tag_name': tag_name,
+        'tag_definition': tag_definition
+    }
+
+
+def _read_last_params(user_id, update, tail):
+    return {
+        'user_id': user_id
+    }
+
+
+def _read_params(user_id, update, tail):
+    return {
+        'user_id': user_id,
+        'message_id': int(tail)
+    }
+
+
+def _read_all_params(user_id, update, tail):
+    return {
+        'user_id': user_id,
+        'page': _parse_page(tail)
+    }
+
+
+def _read_tag_params(user_id, update, tail):
+    tag_name, _, page = tail.strip().partition(' ')
+    return {
+        'user_id': user_id,
+        'tag_name': tag_name,
+        'page': _parse_page(page)
+    }
+
+
+def _tag_params(user_id, update, tail):
+    return {
+        'tags_names': tail.split()
+    }
+
+
+def _tag_all_params(user_id, update, tail):
+    return {}
+
+
+def _search_params(user_id, update, tail):
+    return {
+        'user_id': user_id,
+        'query': tail
+    }
+
+
+def _export_params(user_id, update, tail):
+    return {
+        'user_id': user_id
+    }
+
+
+def _import_params(user_id, update, tail):
+    # файл архива прикрепляется к сообщению с подписью /import
+    document = update['message'].get('document') or {}
+    return {
+        'user_id': user_id,
+        'file_id': document.get('file_id'),
+        'file_size': document.get('file_size'),
+        'update_id': update.get('update_id')
+    }
+
+
+# Соответствие имени команды функции, которая строит ее параметры.
+# Функция принимает id пользователя, обновление и текст после команды;
+# при некорректных параметрах она выбрасывает ValueError.
+PARSERS = {
+    'start': _start_params,
+    'write': _write_params,
+    'write_tag': _write_tag_params,
+    'read_last': _read_last_params,
+    'read': _read_params,
+    'read_all': _read_all_params,
+    'read_tag': _read_tag_params,
+    'tag': _tag_params,
+    'tag_all': _tag_all_params,
+    'search': _search_params,
+    'export': _export_params,
+    'import': _import_params
+}
+
+
+def parse_update(update):
+    """
+    Функция для парсинга одного обновления от API Telegram.
+
+    Возвращает экземпляр Command или None, если обновление не содержит
+    известной боту команды.
+    """
+    message = update.get('message')
+    if not message:
+        return None
+    # команда к прикрепленному файлу передается в подписи
+    text = message.get('text', message.get('caption'))
+    if text is None:
+        return None
+    user_id = message['from']['id']
+    # строка о каждом сообщении подлежит выборке (LOG_SAMPLE), а
+    # форматируется уже в потоке записи журнала
+    if LOG_MESSAGE_TEXT:
+        logger.info(u'user_id:%s, message:%s', user_id, text,
+                    extra={'user_id': user_id, 'sample': True})
+    else:
+        logger.info(u'user_id:%s, message: %s символов', user_id, len(text),
+                    extra={'user_id': user_id, 'sample': True})
+    match = COMMAND_RE.match(text)
+    if not match:
+        return None
+    command, tail = match.groups()
+    parser = PARSERS.get(command)
+    if parser is None:
+        return None
+    params = parser(user_id, update, tail or '')
+    return Command(user_id=user_id, text=command, params=params,
+                   update_id=update.get('update_id'))
 
 
 def parse_data(data):
@@ -52,150 +207,367 @@ def parse_data(data):
     Функция для парсинга содержимого сообщения, принятого ботом.
 
     Принимет словарь (dict) с информацией от API Telegram и возвращает 
-    список (list) комманд (экземпляры класса Command).
+    список (list) комманд (экземпляры класса Command). Некорректное
+    обновление пропускается и не мешает разбору остальных.
     """
     commands = []
     if not data.get('ok'):
-        logging
         return commands
-    result = data.get('result')
-    for update in result:
-        message = update.get('message')
-        user_id = message['from']['id']
-        date = datetime.datetime.fromtimestamp(message.get('date'))
-        text = message.get('text')
-        logger.info(
-            u'user_id:{0}, message:{1}'.format(
-                user_id,
-                text
-            )
-        )
-        match = re.match(r'\/(\w+)\s?(.*\s?)?', text)
-        if match:
-            command, tail = match.groups()
-            if command == 'start':
-                params = {
-                    'user_id': user_id,
-                    'date': date
-                }
-            elif command == 'write':
-                tags = re.findall(r'\#(\S+)', tail)
-                params = {
-                    'user_id': user_id,
-                    'date': date,
-                    'text': tail,
-                    'tags_names': tags
-                }
-            elif command == 'write_tag':
-                tag_name, tag_definition = tail.split(' ', 1)
-                params = {
-                    'tag_name': tag_name,
-                    'tag_definition': tag_definition
-                }
-            elif command == 'read_last':
-                params = {
-                    'user_id': user_id
-                }
-            elif command == 'read':
-                params = {
-                    'user_id': user_id,
-                    'message_id': int(tail)
-                }
-            elif command == 'read_all':
-                params = {
-                    'user_id': user_id
-                }
-            elif command == 'read_tag':
-                params = {
-                    'user_id': user_id,
-                    'tag_name': tail
-                }
-            elif command == 'tag':
-                params = {
-                    'tags_names': tail.split()
-                }
-            elif command == 'tag_all':
-                params = {}
-            else:
-                continue
-            commands.append(Command(user_id=user_id, text=command, params=params))
-        else:
+    for update in data.get('result') or []:
+        try:
+            command = parse_update(update)
+        except (KeyError, TypeError, ValueError, AttributeError) as err:
+            logger.warning(u'Не удалось разобрать обновление %s: %s',
+                           update.get('update_id'), err)
             continue
+        if command is not None:
+            commands.append(command)
     return commands
 
 
+def _split_line(line, limit):
+    for start in range(0, len(line), limit):
+        yield line[start:start + limit]
+
+
+def build_replies(lines, limit=MAX_MESSAGE_LENGTH):
+    """
+    Функция упаковывает строки ответа в минимальное число сообщений.
+
+    Принимает итерируемый объект со строками и возвращает генератор
+    сообщений, каждое из которых не длиннее limit символов; строки
+    внутри сообщения разделяются переводом строки. Слишком длинная
+    строка разбивается на несколько сообщений.
+    """
+    if isinstance(lines, str):
+        lines = [lines]
+    parts = []
+    length = 0
+    for line in lines:
+        line_length = len(line)
+        if line_length > limit:
+            if parts:
+                yield LINE_SEPARATOR.join(parts)
+                parts, length = [], 0
+            for chunk in _split_line(line, limit):
+                yield chunk
+            continue
+        # +1 - разделитель строк
+        if parts and length + 1 + line_length > limit:
+            yield LINE_SEPARATOR.join(parts)
+            parts, length = [], 0
+        length += line_length + (1 if parts else 0)
+        parts.append(line)
+    if parts:
+        yield LINE_SEPARATOR.join(parts)
+
+
+class BaseTelebot:
+    """
+    Общая часть синхронного и асинхронного интерфейсов API Telegram:
+    адреса методов, смещение getUpdates и разбор ответов.
+
+    При инициализации принимает telegram-токен бота, параметры long
+    polling, флаг auto_commit, хранилище смещения getUpdates
+    (offset_store), из которого смещение читается при запуске и в
+    которое сохраняется при подтверждении, а также адрес сервера API
+    (host, port, use_tls).
+    Имеет следующие публичные методы:
+    commit_offset() - подтвердить обработку последних полученных
+                      обновлений; при auto_commit=False следующий
+                      запрос обновлений вернет те же обновления, пока
+                      не вызван этот метод.
+    """
+    HOST = 'api.telegram.org'
+    PORT = 443
+    UPDATE_URL = ('/bot{0}/getUpdates?offset={1}&timeout={2}&limit={3}'
+                  '&allowed_updates=["message"]')
+    SEND_URL = '/bot{0}/sendMessage'
+    SEND_DOCUMENT_URL = '/bot{0}/sendDocument'
+    GET_FILE_URL = '/bot{0}/getFile?{1}'
+    FILE_URL = '/file/bot{0}/{1}'
+    SET_WEBHOOK_URL = '/bot{0}/setWebhook?{1}&allowed_updates=["message"]'
+    DELETE_WEBHOOK_URL = '/bot{0}/deleteWebhook'
+    FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    POLL_TIMEOUT = 30
+    POLL_LIMIT = 100
+    # запас времени сверх timeout long polling на ответ сервера
+    SOCKET_TIMEOUT_MARGIN = 10
+    SOCKET_TIMEOUT = 30
+
+    def __init__(self, bot_id, poll_timeout=POLL_TIMEOUT,
+                 poll_limit=POLL_LIMIT, auto_commit=True, offset_store=None,
+                 host=HOST, port=PORT, use_tls=True):
+        self.id = bot_id
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.offset_store = offset_store
+        self.offset = offset_store.load() if offset_store else None
+        self.pending_offset = None
+        self.auto_commit = auto_commit
+        self.poll_timeout = poll_timeout
+        self.poll_limit = poll_limit
+
+    def _updates_path(self, timeout, limit):
+        if timeout is None:
+            timeout = self.poll_timeout
+        if limit is None:
+            limit = self.poll_limit
+        path = self.UPDATE_URL.format(self.id, self.offset, timeout, limit)
+        return path, timeout + self.SOCKET_TIMEOUT_MARGIN
+
+    def _check_status(self, response):
+        if not 200 <= response.status <= 299:
+            error = 'Error: {0} {1}'.format(response.status, response.reason)
+            logger.error(error)
+
+    def _handle_updates(self, response):
+        # ошибка сервера (например, 502 с HTML-страницей) возвращается
+        # как неудачный ответ, чтобы цикл опроса выждал ERROR_DELAY
+        if not 200 <= response.status <= 299:
+            self._check_status(response)
+            return {'ok': False, 'result': []}
+        try:
+            data_dict = decode_json(response.body)
+        except ValueError as err:
+            logger.error(u'Некорректный ответ getUpdates: %s', err)
+            return {'ok': False, 'result': []}
+        if not isinstance(data_dict, dict):
+            return {'ok': False, 'result': []}
+        try:
+            self.pending_offset = int(data_dict['result'][-1]['update_id']) + 1
+        except IndexError:
+            pass
+        except KeyError:
+            pass
+        if self.auto_commit:
+            self.commit_offset()
+        return data_dict
+
+    def commit_offset(self):
+        if self.pending_offset is None or self.pending_offset == self.offset:
+            return
+        self.offset = self.pending_offset
+        if self.offset_store is not None:
+            self.offset_store.save(self.offset)
+
+    def _reply_body(self, user_id, reply):
+        # ответ до MAX_MESSAGE_LENGTH символов передается в теле POST:
+        # в строке запроса закодированная кириллица заняла бы ~24 КБ
+        return encode_query(
+            {'chat_id': user_id, 'text': reply}).encode('ascii')
+
+    def _webhook_path(self, url, secret_token, max_connections):
+        params = {'url': url, 'max_connections': max_connections}
+        # без секрета Telegram не передает заголовок проверки
+        if secret_token is not None:
+            params['secret_token'] = secret_token
+        return self.SET_WEBHOOK_URL.format(self.id, encode_query(params))
+
 
-class Telebot:
+class Telebot(BaseTelebot):
     """
     Интерфейс для взаимодействия с API Telegram.
 
-    При инициализации экзамляра принимет telegram-токен бота;
+    При инициализации экзамляра принимет telegram-токен бота и
+    (опционально) размер пула постоянных HTTPS-соединений, хранилище
+    смещения getUpdates (offset_store), из которого смещение читается
+    при запуске и в которое сохраняется при подтверждении, а также
+    адрес сервера API (host, port, use_tls), например, тестового;
     Имеет следующие публичные методы:
-    check_updates() - сделать запрос на получения новых сообщений;
+    check_updates(timeout, limit) - сделать long polling запрос на
+                                    получение новых сообщений: сервер
+                                    держит запрос до timeout секунд,
+                                    пока не появятся новые сообщения;
+                                    limit - максимальное число
+                                    сообщений в ответе;
     send_reply(user_id, reply) - отправить ответ поьзователю;
                                  Принимает id пользователя и строку 
                                  с отправляемым ответом.
+    send_document(user_id, filename, document) - отправить пользователю
+                                                 файл (document -
+                                                 двоичный файл,
+                                                 передается блоками);
+    download_file(file_id) - скачать файл, присланный пользователем;
+                             возвращает содержимое (bytes) или None;
+    set_webhook(url, secret_token) - включить доставку обновлений
+                                     на адрес url (webhook);
+    delete_webhook() - отключить webhook и вернуться к getUpdates;
+    commit_offset() - подтвердить обработку последних полученных
+                      обновлений (см. BaseTelebot);
+    close() - закрыть все соединения с сервером.
     """
-    HOST = 'api.telegram.org'
-    PORT = 443
-    UPDATE_URL = ('GET /bot{0}/getUpdates?offset={1}&allowed_updates=["message"] HTTP/1.1\r\n'
-                  'Host: api.telegram.org\r\n'
-                  'Connection: close\r\n\r\n')
-    SEND_URL = ('GET /bot{0}/sendMessage?chat_id={1}&text={2} HTTP/1.1\r\n'
-                'Host: api.telegram.org\r\n'
-                'Connection: close\r\n\r\n')
-
-    def __init__(self, bot_id):
-        self.id = bot_id
-        self.offset = None
+    def __init__(self, bot_id, pool_size=4,
+                 poll_timeout=BaseTelebot.POLL_TIMEOUT,
+                 poll_limit=BaseTelebot.POLL_LIMIT, auto_commit=True,
+                 offset_store=None, host=BaseTelebot.HOST,
+                 port=BaseTelebot.PORT, use_tls=True):
+        super().__init__(bot_id, poll_timeout, poll_limit, auto_commit,
+                         offset_store, host, port, use_tls)
+        self.pool = ConnectionPool(
+            self.host,
+            self.port,
+            size=pool_size,
+            use_tls=self.use_tls,
+            timeout=self.SOCKET_TIMEOUT
+        )
 
-    def _connect(self, host, port):
-        mysock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def _make_request(self, path, timeout=None, http_method='GET', body=None,
+                      headers=None):
+        method = metrics.telegram_method(path)
         try:
-            mysock.connect((host, port))
+            with metrics.TELEGRAM_REQUEST_SECONDS.time(method):
+                response = self.pool.request(
+                    http_method, path, body, headers, timeout=timeout)
         except socket.error as err:
+            metrics.TELEGRAM_RESPONSES.inc(method, 'error')
             logger.error(err, exc_info=True)
-            sys.exit(1)
-        context = ssl.create_default_context()
-        return context.wrap_socket(mysock, server_hostname=host)
+            raise
+        metrics.TELEGRAM_RESPONSES.inc(method, str(response.status))
+        return response
 
-    def _make_request(self, cmd):
-        mysock = self._connect(self.HOST, self.PORT)
+    def check_updates(self, timeout=None, limit=None):
+        path, socket_timeout = self._updates_path(timeout, limit)
         try:
-            mysock.send(cmd.encode('utf-8'))
+            response = self._make_request(path, timeout=socket_timeout)
+        except socket.error:
+            return {'ok': False, 'result': []}
+        return self._handle_updates(response)
+
+    def send_reply(self, user_id, reply):
+        response = self._make_request(
+            self.SEND_URL.format(self.id),
+            http_method='POST',
+            body=self._reply_body(user_id, reply),
+            headers=self.FORM_HEADERS
+        )
+        self._check_status(response)
+        return response
+
+    def send_document(self, user_id, filename, document):
+        boundary = uuid.uuid4().hex
+        head = (
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="chat_id"\r\n\r\n'
+            '{1}\r\n'
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="document"; '
+            'filename="{2}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).format(boundary, user_id, filename)
+        tail = '\r\n--{0}--\r\n'.format(boundary)
+        response = self._make_request(
+            self.SEND_DOCUMENT_URL.format(self.id),
+            http_method='POST',
+            body=[head.encode('utf-8'), document, tail.encode('utf-8')],
+            headers={
+                'Content-Type': 'multipart/form-data; boundary={0}'.format(
+                    boundary)
+            }
+        )
+        self._check_status(response)
+        return response
+
+    def download_file(self, file_id):
+        response = self._make_request(self.GET_FILE_URL.format(
+            self.id, encode_query({'file_id': file_id})))
+        self._check_status(response)
+        data = decode_json(response.body)
+        if not data.get('ok'):
+            return None
+        response = self._make_request(
+            self.FILE_URL.format(self.id, data['result']['file_path']))
+        self._check_status(response)
+        if not 200 <= response.status <= 299:
+            return None
+        return bytes(response.body)
+
+    def set_webhook(self, url, secret_token, max_connections=40):
+        path = self._webhook_path(url, secret_token, max_connections)
+        response = self._make_request(path)
+        self._check_status(response)
+        return decode_json(response.body)
+
+    def delete_webhook(self):
+        response = self._make_request(self.DELETE_WEBHOOK_URL.format(self.id))
+        self._check_status(response)
+        return decode_json(response.body)
+
+    def close(self):
+        self.pool.close()
+
+
+class AsyncTelebot(BaseTelebot):
+    """
+    Асинхронный интерфейс API Telegram для работы внутри цикла
+    событий asyncio.
+
+    Параметры инициализации те же, что у Telebot. Методы
+    check_updates, send_reply, set_webhook, delete_webhook являются
+    корутинами и работают так же, как одноименные методы Telebot;
+    commit_offset() и close() - обычные методы. Файлы (send_document,
+    download_file) передает синхронный Telebot.
+    """
+    def __init__(self, bot_id, pool_size=8,
+                 poll_timeout=BaseTelebot.POLL_TIMEOUT,
+                 poll_limit=BaseTelebot.POLL_LIMIT, auto_commit=True,
+                 offset_store=None, host=BaseTelebot.HOST,
+                 port=BaseTelebot.PORT, use_tls=True):
+        super().__init__(bot_id, poll_timeout, poll_limit, auto_commit,
+                         offset_store, host, port, use_tls)
+        self.pool = AsyncConnectionPool(
+            self.host,
+            self.port,
+            size=pool_size,
+            use_tls=self.use_tls,
+            timeout=self.SOCKET_TIMEOUT
+        )
+
+    async def _make_request(self, path, timeout=None, http_method='GET',
+                            body=None, headers=None):
+        method = metrics.telegram_method(path)
+        try:
+            with metrics.TELEGRAM_REQUEST_SECONDS.time(method):
+                response = await self.pool.request(
+                    http_method, path, body, headers, timeout=timeout)
         except socket.error as err:
+            metrics.TELEGRAM_RESPONSES.inc(method, 'error')
             logger.error(err, exc_info=True)
-        response = b''
-        while True:
-            try:
-                data = mysock.recv(512)
-            except socket.error as err:
-                logger.error(err, exc_info=True)
-            response += data
-            if not data:
-                break
-        mysock.close()
+            raise
+        metrics.TELEGRAM_RESPONSES.inc(method, str(response.status))
         return response
-    
-    def check_updates(self):
-        cmd = self.UPDATE_URL.format(self.id, self.offset)
-        response = self._make_request(cmd)
-        http_response = str(response.decode())
-        status = re.match(r'HTTP/1.1 (\d+) (.+)\s', http_response)
-        status_code, status_description = status.groups()
-        if not 200 <= int(status_code) <= 299:
-            error = 'Error: {0} {1}'.format(status_code, status_description)
-            logger.error(error)
-        pos = http_response.find('\r\n\r\n')
-        data_dict = json.loads(http_response[pos:])
+
+    async def check_updates(self, timeout=None, limit=None):
+        path, socket_timeout = self._updates_path(timeout, limit)
         try:
-            self.offset = int(data_dict['result'][-1]['update_id']) + 1
-        except IndexError:
-            pass
-        except KeyError:
-            pass
-        return data_dict
+            response = await self._make_request(path, timeout=socket_timeout)
+        except socket.error:
+            return {'ok': False, 'result': []}
+        return self._handle_updates(response)
 
-    def send_reply(self, user_id, reply):
-        cmd = unicode(self.SEND_URL, 'utf-8').format(self.id, user_id, reply)
-        self._make_request(cmd)
+    async def send_reply(self, user_id, reply):
+        response = await self._make_request(
+            self.SEND_URL.format(self.id),
+            http_method='POST',
+            body=self._reply_body(user_id, reply),
+            headers=self.FORM_HEADERS
+        )
+        self._check_status(response)
+        return response
+
+    async def set_webhook(self, url, secret_token, max_connections=40):
+        path = self._webhook_path(url, secret_token, max_connections)
+        response = await self._make_request(path)
+        self._check_status(response)
+        return decode_json(response.body)
+
+    async def delete_webhook(self):
+        response = await self._make_request(
+            self.DELETE_WEBHOOK_URL.format(self.id))
+        self._check_status(response)
+        return decode_json(response.body)
+
+    def close(self):
+        self.pool.close()
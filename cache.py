@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+import metrics
+
+
+class TagCache:
+    """
+    Кэш справочника тэгов в памяти процесса.
+
+    При инициализации принимает время жизни кэша в секундах (ttl);
+    если ttl не задан, кэш действует до явной инвалидации. Время жизни
+    нужно, чтобы несколько процессов бота со временем видели тэги,
+    добавленные другими процессами.
+    Поиск по имени не зависит от регистра, как и сравнение строк
+    в MySQL. Кэш помнит и имена, которых нет в базе, пока не истечет
+    время жизни или тэг не будет добавлен через put().
+    Имеет следующие публичные методы:
+    is_loaded() - загружен ли кэш и не истекло ли его время жизни;
+    load(rows) - заполнить кэш строками (id, name, definition);
+    get(name) - вернуть кортеж (id, name, definition) или None;
+    is_missing(name) - известно ли, что тэга с таким именем нет;
+    put_missing(names) - запомнить имена, которых нет в базе;
+    all() - вернуть все тэги в порядке их id;
+    put(tag_id, name, definition) - добавить или обновить тэг;
+    invalidate() - сбросить кэш.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._tags = {}
+        self._missing = set()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def is_loaded(self):
+        with self._lock:
+            if self._loaded_at is None:
+                return False
+            if self.ttl is None:
+                return True
+            return time.monotonic() - self._loaded_at < self.ttl
+
+    def load(self, rows):
+        tags = {}
+        for tag_id, name, definition in rows:
+            tags[name.lower()] = (tag_id, name, definition)
+        with self._lock:
+            self._tags = tags
+            self._missing = set()
+            self._loaded_at = time.monotonic()
+
+    def get(self, name):
+        return self._tags.get(name.lower())
+
+    def is_missing(self, name):
+        return name.lower() in self._missing
+
+    def put_missing(self, names):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._missing.update(name.lower() for name in names)
+
+    def all(self):
+        with self._lock:
+            return sorted(self._tags.values())
+
+    def put(self, tag_id, name, definition):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._tags[name.lower()] = (tag_id, name, definition)
+                self._missing.discard(name.lower())
+
+    def invalidate(self):
+        with self._lock:
+            self._tags = {}
+            self._missing = set()
+            self._loaded_at = None
+
+
+class MessageCache:
+    """
+    LRU-кэш текстов заметок и указателей на последнюю заметку
+    пользователя.
+
+    При инициализации принимает максимальное число записей
+    (max_entries) и максимальный суммарный объем текстов в байтах
+    (max_bytes); при превышении любого из ограничений вытесняются
+    давно не использованные записи.
+    Имеет следующие публичные методы:
+    get(user_id, message_id) - вернуть текст заметки или None;
+    put(user_id, message_id, text) - сохранить текст заметки;
+    get_last(user_id) - вернуть id последней заметки пользователя
+                        или None;
+    set_last(user_id, message_id) - запомнить последнюю заметку;
+    stats() - вернуть словарь со счетчиками попаданий и промахов.
+    Попадания, промахи и размер кэша также учитываются в метриках
+    (metrics.MESSAGE_CACHE_*).
+    """
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._messages = OrderedDict()
+        self._last = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, message_id):
+        key = (user_id, message_id)
+        with self._lock:
+            text = self._messages.get(key)
+            if text is None:
+                self.misses += 1
+            else:
+                self._messages.move_to_end(key)
+                self.hits += 1
+        metrics.MESSAGE_CACHE_REQUESTS.inc('miss' if text is None else 'hit')
+        return text
+
+    def put(self, user_id, message_id, text):
+        key = (user_id, message_id)
+        size = sys.getsizeof(text)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._messages.pop(key, None)
+            if old is not None:
+                self.size -= sys.getsizeof(old)
+            self._messages[key] = text
+            self.size += size
+            while (len(self._messages) > self.max_entries
+                   or self.size > self.max_bytes):
+                _, evicted = self._messages.popitem(last=False)
+                self.size -= sys.getsizeof(evicted)
+            metrics.MESSAGE_CACHE_ENTRIES.set(len(self._messages))
+            metrics.MESSAGE_CACHE_BYTES.set(self.size)
+
+    def get_last(self, user_id):
+        with self._lock:
+            message_id = self._last.get(user_id)
+            if message_id is not None:
+                self._last.move_to_end(user_id)
+            return message_id
+
+    def set_last(self, user_id, message_id):
+        with self._lock:
+            self._last[user_id] = message_id
+            self._last.move_to_end(user_id)
+            if len(self._last) > self.max_entries:
+                self._last.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._messages),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
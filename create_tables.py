@@ -3,6 +3,9 @@ import os
 from dotenv import load_dotenv
 
 from db_connector import DbConnector, DB
+from log_config import setup_logging
+from sqlite_storage import SqliteStorage
+from storage import StorageBackend
 from tables import TABLES
 
 
@@ -11,9 +14,33 @@ if os.path.exists(dotenv_path):
     load_dotenv(dotenv_path)
 
 
+# существующие заметки сжимаются после миграции, если задан NOTE_COMPRESSION
+NOTE_COMPRESSION = {
+    'compression': os.environ.get('NOTE_COMPRESSION') or None,
+    'compress_threshold': int(os.environ.get(
+        'NOTE_COMPRESS_THRESHOLD', StorageBackend.COMPRESS_THRESHOLD))
+}
+
+
 if __name__ == '__main__':
-    conn = DbConnector(**DB)
-    conn.open_connection()
-    conn.create_database(os.environ.get('DB_NAME'))
-    conn.create_tables(**TABLES)
-    conn.close_connection()
\ No newline at end of file
+    setup_logging()
+    if os.environ.get('STORAGE') == 'sqlite':
+        conn = SqliteStorage(
+            os.environ.get('SQLITE_PATH', 'bot.sqlite3'), **NOTE_COMPRESSION)
+        conn.create_tables(*TABLES)
+        conn.migrate()
+        conn.compress_notes()
+        conn.close_connection()
+    else:
+        conn = DbConnector(**DB, **NOTE_COMPRESSION)
+        conn.open_connection()
+        db_name = os.environ.get('DB_NAME')
+        # для существующей базы применяются только недостающие миграции
+        if not conn.database_exists(db_name):
+            conn.create_database(db_name)
+            conn.create_tables(*TABLES)
+        else:
+            conn.cnx.database = db_name
+        conn.migrate()
+        conn.compress_notes()
+        conn.close_connection()
@@ -1,27 +1,19 @@
 # -*- coding: utf-8 -*-
+from contextlib import contextmanager
 import logging
-from logging.handlers import RotatingFileHandler
 import os
+import threading
 
 from dotenv import load_dotenv
 import mysql.connector
-from mysql.connector import errorcode
+from mysql.connector import errorcode, pooling
 
-from tables import TABLES
+import note_compression
+from storage import StorageBackend
+from tables import MIGRATIONS
 
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = RotatingFileHandler(
-    'bot_logs.log',
-    maxBytes=1000000,
-    backupCount=5
-)
-formatter = logging.Formatter(
-    '%(asctime)s - %(name)-12s - %(levelname)s - %(message)s'
-)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if os.path.exists(dotenv_path):
@@ -35,61 +27,77 @@ DB = {
 }
 
 
-class DbConnector:
+class DbConnector(StorageBackend):
     """
-    Интерфейс для взаимодействия с базой данных.
+    Хранилище заметок в MySQL.
 
     При создании нового класса принимает следующие аргументы:
     -user: имя пользователя базы данных, имеющий доступ к СУБД;
     -password - пароль пользователя;
     -host - имя хоста или ip-адрес сервера СУБД;
-    -datebase - имя базы данных (опционально).
+    -datebase - имя базы данных (опционально);
+    а также аргументы кэшей и сжатия заметок StorageBackend.
 
-    Имеет следующие методы:
+    Кроме команд StorageBackend имеет следующие методы:
     open_connection() - создает соединение с базой данных
     close_connection() - закрывает соединение с базой данных
     create_database(name) - создает новую базу данных
     create_tables(seq) - создает таблицы, переданные в виде 
                          последовательности строк, содержащих 
                          SQL-запросы по созданию таблиц;
-    add_user(user_id) - добавляет нового пользователя в базу
-    tag(seq) - принимет последовательность строк с именами тэгов
-               и возвращает строку с их описанием;
-    write(date, text, user_id, tags_names) - 
-               добавляет новое сообщение в базу. Принимает дату, 
-               текст, id пользователя и имена тегов, связанных с ним.
-               Возвращает строку с уведомлением о сохранении сообщения 
-               и его id. 
-    write_tag(name, definition) - добавляет новый тэг;
-    read_last(usеr_id) - принимет id пользователя и возвращает
-                         последнее сохраненное сообщение от него;
-    read(user_id, message_id) - принимет id пользователя и id сообщения
-                                и возвращает последнее сохраненное 
-                                сообщение от него;
-    read_all(user_id) - принимет id пользователя и возвращает все 
-                        его сообщения;
-    read_tag(user_id, tag_name) - принимет id пользователя и имя тега
-                                  и возвращает все его сообщения, 
-                                  связанные с указанным тегом;
-    tag_all()  - возвращает все имеющиеся в базе тэги.
+    migrate() - применяет недостающие миграции схемы (индексы и
+                другие изменения существующих таблиц).
+
+    Если передан аргумент pool_size, open_connection() создает пул из
+    pool_size соединений, и каждая команда берет соединение из пула
+    на время своего выполнения; иначе все команды используют одно
+    соединение.
+    Поиск использует полнотекстовый индекс MySQL; если индекса нет
+    или включено сжатие заметок (индекс не видит текст сжатых
+    заметок), для пользователя строится инвертированный индекс
+    в памяти.
     """
-    def __init__(self, user, password, host, database=None):
+    RECONNECT_ATTEMPTS = 3
+    RECONNECT_DELAY = 1
+    IntegrityError = mysql.connector.IntegrityError
+
+    def __init__(self, user, password, host, database=None, pool_size=None,
+                 tag_cache_ttl=None, message_cache_entries=10000,
+                 message_cache_bytes=16 * 1024 * 1024, compression=None,
+                 compress_threshold=StorageBackend.COMPRESS_THRESHOLD):
         self.user = user
         self.password = password
         self.host = host
         self.database = database
+        self.pool_size = pool_size
         self.cnx = None
+        self.pool = None
+        self._pool_slots = None
+        super().__init__(tag_cache_ttl, message_cache_entries,
+                         message_cache_bytes, compression, compress_threshold)
+        self.fulltext = self.compression == note_compression.NONE
+
+    def _connect_args(self):
+        return {
+            'user': self.user,
+            'password': self.password,
+            'host': self.host,
+            'database': self.database,
+            'use_unicode': True,
+            'charset': 'utf8mb4'
+        }
 
     def open_connection(self):
         try:
-            cnx = mysql.connector.connect(
-                user=self.user,
-                password=self.password,
-                host=self.host,
-                database=self.database,
-                use_unicode=True,
-                charset='utf8mb4'
-            )
+            if self.pool_size:
+                self.pool = pooling.MySQLConnectionPool(
+                    pool_name='message_bot_{0}'.format(id(self)),
+                    pool_size=self.pool_size,
+                    **self._connect_args()
+                )
+                self._pool_slots = threading.BoundedSemaphore(self.pool_size)
+                return
+            cnx = mysql.connector.connect(**self._connect_args())
         except mysql.connector.Error as err:
             if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
                 logger.error('Неверное имя пользователя или пароль')
@@ -103,8 +111,37 @@ class DbConnector:
         self.cnx = cnx
 
     def close_connection(self):
+        if self.pool is not None:
+            self.pool = None
+            self._pool_slots = None
+            return
         self.cnx.close()
 
+    @contextmanager
+    def _connection(self):
+        """
+        Выдает соединение с базой на время выполнения одной команды.
+
+        В режиме пула соединение берется из пула (при исчерпании пула
+        ожидается освобождение соединения) и возвращается в него после
+        выполнения команды. Перед выдачей соединение проверяется и при
+        обрыве связи с сервером переоткрывается.
+        """
+        if self.pool is None:
+            self.cnx.ping(reconnect=True, attempts=self.RECONNECT_ATTEMPTS,
+                          delay=self.RECONNECT_DELAY)
+            yield self.cnx
+            return
+        with self._pool_slots:
+            cnx = self.pool.get_connection()
+            try:
+                cnx.ping(reconnect=True, attempts=self.RECONNECT_ATTEMPTS,
+                         delay=self.RECONNECT_DELAY)
+                yield cnx
+            finally:
+                # для соединения из пула close() возвращает его в пул
+                cnx.close()
+
     def create_database(self, db_name):
         cursor = self.cnx.cursor()
         try:
@@ -115,6 +152,13 @@ class DbConnector:
             exit(1)
         self.database = db_name
 
+    def database_exists(self, db_name):
+        cursor = self.cnx.cursor()
+        cursor.execute('SHOW DATABASES LIKE %s;', (db_name,))
+        exists = cursor.fetchone() is not None
+        cursor.close()
+        return exists
+
     def create_tables(self, *tables):
         cursor = self.cnx.cursor()
         try:
@@ -133,172 +177,67 @@ class DbConnector:
                 exit(1)
         cursor.close()
 
-    def add_user(self, user_id, date):
-        cursor = self.cnx.cursor()
-        check_user_exists = (
-            'SELECT count(*) FROM users '
-            'WHERE id=%s;'
-        )
-        cursor.execute(check_user_exists, (user_id,))
-        count = int(next(cursor)[0])
-        if count != 0:
-            cursor.close()
-            return
-        add_user = (
-            'INSERT INTO users (id, first_addressing) '
-            'VALUES '
-            '    (%s, %s);'
-        )
-        cursor.execute(add_user, (user_id, date))
-        self.cnx.commit()
-        cursor.close()
-
-    def tag(self, tags_names):
-        cursor = self.cnx.cursor()
-        result = []
-        for name in tags_names:
-            tags_query = (
-                'SELECT CONCAT("%23", name, " - ", definition) FROM tags '
-                'WHERE name=%s;'
-            )
-            cursor.execute(tags_query, (name,))
-            try:
-                result.append(next(cursor)[0])
-            except StopIteration:
-                break
-        cursor.close()
-        return '%0A'.join(result)
-
-    def _get_tag_id(self, *tags_names):
-        cursor = self.cnx.cursor()
-        result = []
-        for name in tags_names:
-            tags_query = (
-                'SELECT id FROM tags '
-                'WHERE name=%s;'
-            )
-            cursor.execute(tags_query, (name,))
-            try:
-                result.append(next(cursor)[0])
-            except StopIteration:
-                break
-        cursor.close()
-        return '%0A'.join(result)
-
-    def write(self, date, text, user_id, tags_names):
-        cursor = self.cnx.cursor()
-        add_message = (
-            'INSERT INTO messages (date, text, user_id) '
-            'VALUES '
-            '    (%s, %s, %s);'
-        )
-        cursor.execute(add_message, (date, text, user_id))
-        message_id = cursor.lastrowid
-        add_last_message = (
-            'UPDATE users '
-            'SET last_message_id=%s '
-            'WHERE id=%s;'
-        )
-        cursor.execute(add_last_message, (message_id, user_id))
-        tags = self._get_tag_id(*tags_names)
-        for tag_id in tags:
-            add_message_tag = (
-                'INSERT INTO messages_tags (message_id, tag_id) '
-                'VALUES '
-                '    (%s, %s);'
-            )
-            cursor.execute(add_message_tag, (message_id, tag_id))
-        self.cnx.commit()
-        cursor.close()
-        return u'заметка {0} сохранена'.format(message_id)
+    def migrate(self, migrations=MIGRATIONS):
+        """
+        Применяет к базе данных миграции схемы, которые еще не применены.
 
-    def write_tag(self, tag_name, tag_definition):
+        Текущая версия схемы хранится в таблице schema_version; после
+        каждой миграции версия обновляется, поэтому прерванный процесс
+        можно просто запустить повторно.
+        """
         cursor = self.cnx.cursor()
-        find_tag = (
-            'SELECT id FROM tags '
-            'WHERE name=%s;'
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS schema_version ('
+            '    version INT UNSIGNED NOT NULL'
+            ');'
         )
-        cursor.execute(find_tag, (tag_name,))
-        try:
-            tag_id = next(cursor)[0]
-            update_tag = (
-                'UPDATE tags '
-                'SET definition=%s '
-                'WHERE id=%s;'
-            )
-            cursor.execute(update_tag, (tag_definition, tag_id))
-        except StopIteration:
-            add_tag = (
-                'INSERT INTO tags (name, definition) '
-                'VALUES '
-                '    (%s, %s);'
+        cursor.execute('SELECT MAX(version) FROM schema_version;')
+        current = cursor.fetchone()[0] or 0
+        for version, statements in migrations:
+            if version <= current:
+                continue
+            logger.info('Применение миграции {0}'.format(version))
+            for statement in statements:
+                try:
+                    cursor.execute(statement)
+                except mysql.connector.Error as err:
+                    # индекс уже создан предыдущим прерванным запуском
+                    if err.errno != errorcode.ER_DUP_KEYNAME:
+                        logger.error(err)
+                        raise
+            cursor.execute('DELETE FROM schema_version;')
+            cursor.execute(
+                'INSERT INTO schema_version (version) VALUES (%s);',
+                (version,)
             )
-            cursor.execute(add_tag, (tag_name, tag_definition))
-        finally:
             self.cnx.commit()
-            cursor.close()   
-
-    def read_last(self, user_id):
-        cursor = self.cnx.cursor()
-        text_query = (
-            'SELECT text FROM messages '
-            'JOIN users ON users.last_message_id=messages.id '
-            'WHERE users.id=%s;'
-        )
-        cursor.execute(text_query, (user_id,))
-        try:
-            text, = next(cursor)
-        except StopIteration:
-            return u''
         cursor.close()
-        return text.replace('#', '%23')
 
-    def read(self, user_id, message_id):
-        cursor = self.cnx.cursor()
-        text_query = (
-            'SELECT text, user_id FROM messages '
-            'WHERE id=%s;'
+    def _is_duplicate(self, err):
+        return err.errno == errorcode.ER_DUP_ENTRY
+
+    def _fulltext_search(self, user_id, query, limit):
+        search_query = (
+            'SELECT id, text, '
+            '    MATCH(text) AGAINST (%s IN NATURAL LANGUAGE MODE) AS score '
+            'FROM messages '
+            'WHERE user_id=%s '
+            '    AND MATCH(text) AGAINST (%s IN NATURAL LANGUAGE MODE) '
+            'ORDER BY score DESC '
+            'LIMIT %s;'
         )
-        cursor.execute(text_query, (message_id,))
-        try:
-            text, owner_id = next(cursor)
-        except StopIteration:
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            try:
+                cursor.execute(search_query, (query, user_id, query, limit))
+            except mysql.connector.Error as err:
+                if err.errno != errorcode.ER_FT_MATCHING_KEY_NOT_FOUND:
+                    raise
+                logger.warning('Нет полнотекстового индекса, поиск по '
+                               'индексу в памяти')
+                self.fulltext = False
+                cursor.close()
+                return None
+            rows = [(message_id, text) for message_id, text, _ in cursor]
             cursor.close()
-            return u'заметка {0} не найдена'.format(message_id)
-        cursor.close()
-        if user_id == owner_id:
-            return text.replace('#', '%23')
-        return (u'заметка {0} принадлежит другому '
-                u'пользователю').format(message_id)
-
-    def read_all(self, user_id):
-        cursor = self.cnx.cursor()
-        text_query = (
-            'SELECT text FROM messages '
-            'WHERE user_id=%s;'
-        )
-        cursor.execute(text_query, (user_id,))
-        result = [row[0].replace('#', '%23') for row in cursor]
-        cursor.close()
-        return '%0A'.join(result)
-
-    def read_tag(self, user_id, tag_name):
-        cursor = self.cnx.cursor()
-        text_query = (
-            'SELECT text FROM messages '
-            'JOIN messages_tags ON messages.id = messages_tags.message_id '
-            'JOIN tags ON tags.id = messages_tags.tag_id '
-            'WHERE user_id=%s AND tags.name=%s;'
-        )
-        cursor.execute(text_query, (user_id, tag_name))
-        result = [row[0].replace('#', '%23') for row in cursor]
-        cursor.close()
-        return '%0A'.join(result)
-
-    def tag_all(self):
-        cursor = self.cnx.cursor()
-        text_query = 'SELECT CONCAT("%23", name, "-", definition) FROM tags;'
-        cursor.execute(text_query)
-        result = [row[0] for row in cursor]
-        cursor.close()
-        return '%0A'.join(result)
+        return rows
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    """
+    Конкурентный диспетчер команд для asyncio.
+
+    При инициализации принимает:
+    -handler - корутину handler(command), выполняющую одну команду;
+    -max_in_flight - максимальное число одновременно выполняемых команд.
+
+    Команды разных пользователей выполняются параллельно, команды
+    одного пользователя - строго в порядке поступления.
+    Имеет следующие публичные методы:
+    submit(command) - поставить команду в очередь пользователя;
+    join() - дождаться выполнения всех поставленных команд.
+    """
+    def __init__(self, handler, max_in_flight=32):
+        self.handler = handler
+        self.max_in_flight = max_in_flight
+        self._semaphore = None
+        self._queues = {}
+        self._workers = {}
+
+    def submit(self, command):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        user_queue = self._queues.get(command.user_id)
+        if user_queue is None:
+            user_queue = self._queues[command.user_id] = asyncio.Queue()
+        user_queue.put_nowait(command)
+        if command.user_id not in self._workers:
+            self._workers[command.user_id] = asyncio.ensure_future(
+                self._worker(command.user_id))
+
+    async def _worker(self, user_id):
+        user_queue = self._queues[user_id]
+        try:
+            while not user_queue.empty():
+                command = user_queue.get_nowait()
+                async with self._semaphore:
+                    try:
+                        await self.handler(command)
+                    except Exception as err:
+                        logger.error(err, exc_info=True)
+        finally:
+            # очередь пуста: освобождаем ресурсы пользователя до
+            # следующей команды
+            del self._workers[user_id]
+            del self._queues[user_id]
+
+    async def join(self):
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()))
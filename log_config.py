@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import atexit
+import datetime
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import random
+
+from dotenv import load_dotenv
+
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+
+# файл журнала и параметры его ротации
+LOG_FILE = os.environ.get('LOG_FILE', 'bot_logs.log')
+LOG_MAX_BYTES = 1000000
+LOG_BACKUP_COUNT = 5
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# формат журнала: text или json (одна строка JSON на запись)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# записывать ли в журнал тексты сообщений пользователей
+LOG_MESSAGE_TEXT = os.environ.get('LOG_MESSAGE_TEXT', '1') != '0'
+# доля записываемых строк о каждом входящем сообщении по уровням,
+# например 'INFO=0.1,DEBUG=0.01'; уровни без доли записываются все
+LOG_SAMPLE = os.environ.get('LOG_SAMPLE', '')
+
+TEXT_FORMAT = '%(asctime)s - %(name)-12s - %(levelname)s - %(message)s'
+# атрибуты LogRecord, которые не являются полями extra
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord(
+    '', logging.INFO, '', 0, '', (), None)))
+RECORD_ATTRIBUTES.update(('message', 'asctime', 'sample'))
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Форматирует запись журнала как одну строку JSON.
+
+    Кроме времени, уровня, имени логгера и сообщения в строку попадают
+    поля, переданные в extra (например, user_id).
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает долю записей, помеченных extra={'sample': True}.
+
+    При инициализации принимает словарь {уровень: доля}; записи без
+    пометки и записи уровней, которых нет в словаре, не отбрасываются.
+    """
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if not getattr(record, 'sample', False):
+            return True
+        rate = self.rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        level, _, rate = part.partition('=')
+        rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+class _LocalQueueHandler(QueueHandler):
+    # очередь не покидает процесс, поэтому запись передается как есть,
+    # а сообщение форматируется уже в потоке записи на диск
+    def prepare(self, record):
+        return record
+
+
+def _file_handler():
+    file_handler = RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding='utf-8'
+    )
+    if LOG_FORMAT == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    return file_handler
+
+
+def _install(queue_handler):
+    queue_handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE)))
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+
+def setup_logging(log_queue=None):
+    """
+    Настраивает журнал процесса.
+
+    Логгеры модулей передают записи в очередь, а единственный файловый
+    обработчик с ротацией пишет их на диск в отдельном потоке
+    (QueueListener), поэтому запись журнала не задерживает обработку
+    команд. Если передана очередь multiprocessing (log_queue), в нее же
+    пишут дочерние процессы (см. attach_to_queue), и ротацией файла
+    по-прежнему управляет один процесс.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    if log_queue is None:
+        log_queue = queue.SimpleQueue()
+        _install(_LocalQueueHandler(log_queue))
+    else:
+        _install(QueueHandler(log_queue))
+    _listener = QueueListener(
+        log_queue, _file_handler(), respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def attach_to_queue(log_queue):
+    """
+    Направляет журнал дочернего процесса в очередь log_queue
+    родительского процесса, настроенного setup_logging(log_queue).
+    """
+    global _listener
+    _listener = None
+    _install(QueueHandler(log_queue))
+
+
+def stop_logging():
+    """
+    Дописывает оставшиеся в очереди записи и останавливает поток
+    записи журнала.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
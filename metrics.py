@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from collections import Counter as _Tally
+from contextlib import contextmanager
+import cProfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+
+logger = logging.getLogger(__name__)
+
+
+# границы корзин гистограмм задержки в секундах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# максимальная длительность профилирования по запросу в секундах
+MAX_PROFILE_SECONDS = 300
+
+QUERY_RE = re.compile(
+    r'^\s*(\w+)\s+(?:.*?\b(?:FROM|INTO|TABLE)\s+|)(\w+)', re.I | re.S)
+TELEGRAM_METHOD_RE = re.compile(r'/bot[^/]*/(\w+)')
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(name, _escape(value))
+                          for name, value in pairs) + '}'
+
+
+class Counter:
+    """
+    Счетчик в формате Prometheus.
+
+    При инициализации принимает имя, описание и имена меток.
+    Имеет следующие публичные методы:
+    inc(*labels, amount=1) - увеличить счетчик с заданными значениями
+                             меток;
+    render() - вернуть строки счетчика в текстовом формате Prometheus.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{0}{1} {2}'.format(self.name, _labels(self.labels, key), value)
+                for key, value in values]
+
+
+class Gauge:
+    """
+    Текущее значение величины в формате Prometheus (например, длина
+    очереди).
+
+    При инициализации принимает имя, описание и имена меток.
+    Имеет следующие публичные методы:
+    set(value, *labels) - установить значение с заданными значениями
+                          меток;
+    render() - вернуть строки в текстовом формате Prometheus.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{0}{1} {2}'.format(self.name, _labels(self.labels, key), value)
+                for key, value in values]
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus.
+
+    При инициализации принимает имя, описание, имена меток и границы
+    корзин.
+    Имеет следующие публичные методы:
+    observe(value, *labels) - учесть значение;
+    time(*labels) - контекстный менеджер, учитывающий время
+                    выполнения блока в секундах;
+    render() - вернуть строки гистограммы в текстовом формате
+               Prometheus.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total))
+                            for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name,
+                    _labels(self.labels, key, [('le', bound)]),
+                    cumulative
+                ))
+            lines.append('{0}_sum{1} {2}'.format(
+                self.name, _labels(self.labels, key), total))
+            lines.append('{0}_count{1} {2}'.format(
+                self.name, _labels(self.labels, key), cumulative))
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик процесса.
+
+    Имеет следующие публичные методы:
+    counter(name, documentation, labels) - создать и зарегистрировать
+                                           счетчик;
+    gauge(name, documentation, labels) - создать и зарегистрировать
+                                         текущее значение;
+    histogram(name, documentation, labels) - создать и
+                                             зарегистрировать
+                                             гистограмму;
+    render() - вернуть все метрики в текстовом формате Prometheus.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, labels=()):
+        metric = Gauge(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(
+                metric.name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+COMMAND_SECONDS = REGISTRY.histogram(
+    'bot_command_duration_seconds',
+    'Время выполнения команды вместе с чтением результата',
+    ['command'])
+COMMAND_ERRORS = REGISTRY.counter(
+    'bot_command_errors_total', 'Команды, завершившиеся ошибкой',
+    ['command'])
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'bot_db_query_duration_seconds', 'Время выполнения запроса к базе',
+    ['query'])
+DB_QUERY_ERRORS = REGISTRY.counter(
+    'bot_db_query_errors_total', 'Запросы к базе, завершившиеся ошибкой',
+    ['query'])
+TELEGRAM_REQUEST_SECONDS = REGISTRY.histogram(
+    'bot_telegram_request_duration_seconds',
+    'Время выполнения запроса к API Telegram', ['method'])
+TELEGRAM_RESPONSES = REGISTRY.counter(
+    'bot_telegram_responses_total',
+    'Ответы API Telegram по HTTP-статусу', ['method', 'status'])
+SEND_QUEUE_DEPTH = REGISTRY.gauge(
+    'bot_send_queue_depth', 'Ответы в очереди отправки')
+SEND_LATENCY_SECONDS = REGISTRY.histogram(
+    'bot_send_latency_seconds',
+    'Время от постановки ответа в очередь до его доставки')
+SEND_RESULTS = REGISTRY.counter(
+    'bot_send_results_total',
+    'Отправка ответов: sent, failed, retried, throttled', ['result'])
+MESSAGE_CACHE_REQUESTS = REGISTRY.counter(
+    'bot_message_cache_requests_total',
+    'Обращения к кэшу заметок: hit или miss', ['result'])
+MESSAGE_CACHE_ENTRIES = REGISTRY.gauge(
+    'bot_message_cache_entries', 'Число заметок в кэше')
+MESSAGE_CACHE_BYTES = REGISTRY.gauge(
+    'bot_message_cache_bytes', 'Объем заметок в кэше в байтах')
+
+_query_names = {}
+
+
+def query_name(query):
+    """
+    Возвращает метку запроса вида 'SELECT messages' (тип запроса
+    и первая таблица).
+    """
+    name = _query_names.get(query)
+    if name is None:
+        match = QUERY_RE.match(query)
+        if match is None:
+            name = 'other'
+        else:
+            name = '{0} {1}'.format(
+                match.group(1).upper(), match.group(2).lower())
+        _query_names[query] = name
+    return name
+
+
+def telegram_method(path):
+    match = TELEGRAM_METHOD_RE.match(path)
+    return match.group(1) if match else 'other'
+
+
+class CommandProfiler:
+    """
+    Профилирование выполнения команд модулем cProfile по запросу.
+
+    Пока профилирование не включено, команды выполняются без
+    накладных расходов. Каждая команда профилируется в своем потоке,
+    результаты объединяются.
+    Имеет следующие публичные методы:
+    enable() - начать профилирование команд;
+    disable() - закончить профилирование и вернуть отчет pstats
+                (функции, упорядоченные по суммарному времени);
+    profile() - контекстный менеджер, профилирующий блок, если
+                профилирование включено.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def enable(self):
+        with self._lock:
+            self._stats = None
+            self.enabled = True
+
+    def disable(self, limit=50):
+        with self._lock:
+            self.enabled = False
+            stats, self._stats = self._stats, None
+        if stats is None:
+            return 'Нет выполненных команд\n'
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    @contextmanager
+    def profile(self):
+        if not self.enabled:
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # в потоке уже работает другой профилировщик
+            yield
+            return
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profiler)
+                else:
+                    self._stats.add(profiler)
+
+
+class SamplingProfiler:
+    """
+    Статистический профилировщик всех потоков процесса.
+
+    Через каждые interval секунд снимает стеки всех потоков и считает,
+    сколько раз встретился каждый стек. Результат выводится в формате
+    свернутых стеков (строка 'функция;функция;... число'), который
+    принимают flamegraph.pl и speedscope.
+    Имеет следующие публичные методы:
+    run(seconds) - профилировать seconds секунд и вернуть отчет.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    def run(self, seconds):
+        own = threading.get_ident()
+        stacks = _Tally()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0} ({1}:{2})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return ''.join('{0} {1}\n'.format(stack, count)
+                       for stack, count in stacks.most_common())
+
+
+PROFILER = CommandProfiler()
+
+
+@contextmanager
+def command_timer(name):
+    """
+    Учитывает время выполнения команды name и ошибки в метриках и,
+    если оно включено, профилирует выполнение.
+    """
+    started = time.perf_counter()
+    try:
+        with PROFILER.profile():
+            yield
+    except Exception:
+        COMMAND_ERRORS.inc(name)
+        raise
+    finally:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class MetricsServer:
+    """
+    HTTP-сервер метрик и профилирования.
+
+    При инициализации принимает адрес и порт.
+    Обслуживает запросы:
+    GET /metrics - метрики в текстовом формате Prometheus;
+    GET /profile?seconds=N - профилировать команды модулем cProfile
+                             N секунд и вернуть отчет;
+    GET /profile?seconds=N&mode=sample - снимать стеки всех потоков
+                                         N секунд и вернуть свернутые
+                                         стеки.
+    Имеет следующие публичные методы:
+    start() - запустить сервер в фоновом потоке;
+    stop() - остановить сервер.
+    """
+    def __init__(self, host='127.0.0.1', port=9100, registry=REGISTRY,
+                 profiler=PROFILER):
+        self.registry = registry
+        self.profiler = profiler
+        self._profile_lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._request_handler())
+        self.server.daemon_threads = True
+
+    def _request_handler(self):
+        metrics_server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                params = parse_qs(url.query)
+                if url.path == '/metrics':
+                    status, body = 200, metrics_server.registry.render()
+                elif url.path == '/profile':
+                    status, body = metrics_server.profile(
+                        params.get('seconds', ['10'])[0],
+                        params.get('mode', ['cprofile'])[0])
+                else:
+                    status, body = 404, 'Not found\n'
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def profile(self, seconds, mode):
+        try:
+            seconds = min(float(seconds), MAX_PROFILE_SECONDS)
+        except ValueError:
+            return 400, 'Неверная длительность\n'
+        if not self._profile_lock.acquire(blocking=False):
+            return 409, 'Профилирование уже выполняется\n'
+        try:
+            logger.info('Профилирование ({0}) на {1} с'.format(mode, seconds))
+            if mode == 'sample':
+                return 200, SamplingProfiler().run(seconds)
+            self.profiler.enable()
+            try:
+                time.sleep(seconds)
+            finally:
+                report = self.profiler.disable()
+            return 200, report
+        finally:
+            self._profile_lock.release()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
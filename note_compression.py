@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# значения флага messages.compression
+NONE = 0
+ZLIB = 1
+ZSTD = 2
+METHODS = {
+    'zlib': ZLIB,
+    'zstd': ZSTD
+}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def method_id(name):
+    """
+    Возвращает значение флага сжатия для имени метода ('zlib', 'zstd')
+    или NONE, если имя не задано.
+    """
+    if not name:
+        return NONE
+    method = METHODS.get(name)
+    if method is None:
+        raise ValueError('Неизвестный метод сжатия: {0}'.format(name))
+    if method == ZSTD and zstandard is None:
+        raise ValueError('Для сжатия zstd нужен пакет zstandard')
+    return method
+
+
+def compress(data, method):
+    if method == ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if method == ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError('Неизвестный метод сжатия: {0}'.format(method))
+
+
+def decompress(body, method):
+    if method == ZLIB:
+        return zlib.decompress(body)
+    if method == ZSTD:
+        if zstandard is None:
+            raise ValueError('Для чтения заметок, сжатых zstd, нужен '
+                             'пакет zstandard')
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError('Неизвестный метод сжатия: {0}'.format(method))
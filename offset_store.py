@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import os
+
+
+class FileOffsetStore:
+    """
+    Хранение смещения getUpdates в локальном файле.
+
+    При инициализации принимает путь к файлу.
+    Запись атомарна: новое значение записывается во временный файл,
+    сбрасывается на диск (fsync) и заменяет старый файл, поэтому
+    после сбоя в файле всегда остается последнее подтвержденное
+    смещение.
+    Имеет следующие публичные методы:
+    load() - вернуть сохраненное смещение или None;
+    save(offset) - сохранить смещение.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def load(self):
+        try:
+            with open(self.path) as offset_file:
+                return int(offset_file.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def save(self, offset):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(tmp_path, self.path)
+        # fsync каталога закрепляет на диске саму замену файла
+        dir_fd = os.open(os.path.dirname(self.path), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
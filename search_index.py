@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+import math
+import re
+import threading
+
+
+WORD_RE = re.compile(r'\w+', re.U)
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    Инвертированный индекс заметок одного пользователя в памяти.
+
+    Используется для поиска, когда база данных не поддерживает
+    полнотекстовые индексы. Хранит только списки вхождений слов
+    (слово -> {id заметки: число вхождений}), сами тексты заметок
+    не хранятся.
+    Имеет следующие публичные методы:
+    add(message_id, text) - проиндексировать заметку;
+    search(query, limit) - вернуть список id не более чем limit
+                           заметок, упорядоченный по релевантности
+                           (tf-idf).
+    """
+    def __init__(self):
+        self.postings = {}
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def add(self, message_id, text):
+        with self._lock:
+            for word, count in Counter(tokenize(text)).items():
+                self.postings.setdefault(word, {})[message_id] = count
+            self.documents += 1
+
+    def search(self, query, limit):
+        scores = Counter()
+        with self._lock:
+            for word in set(tokenize(query)):
+                matches = self.postings.get(word)
+                if not matches:
+                    continue
+                idf = math.log(1 + self.documents / len(matches))
+                for message_id, count in matches.items():
+                    scores[message_id] += count * idf
+        return [message_id for message_id, _ in scores.most_common(limit)]
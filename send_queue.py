@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import collections
+import logging
+import queue
+import socket
+import threading
+import time
+
+import metrics
+from transport import decode_json
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты по алгоритму token bucket.
+
+    При инициализации принимает скорость пополнения (токенов в секунду)
+    и емкость корзины (допустимый всплеск).
+    Метод reserve() забирает один токен и возвращает время в секундах,
+    которое нужно подождать перед отправкой.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class BaseSendQueue:
+    """
+    Общая часть очередей отправки SendQueue и AsyncSendQueue:
+    ограничители частоты, учет очереди, разбор ответа Telegram
+    и статистика.
+
+    При инициализации принимает экземпляр бота и параметры:
+    -workers - число обработчиков, параллельно отправляющих сообщения;
+    -chat_rate, chat_burst - допустимая частота (в секунду) и всплеск
+                             сообщений в один чат;
+    -global_rate, global_burst - то же для всех чатов вместе;
+    -max_retries - число повторных попыток при ошибке отправки;
+    -backoff - начальная пауза перед повтором (удваивается с каждой
+               попыткой).
+    Имеет следующие публичные методы:
+    put(user_id, reply) - поставить сообщение в очередь;
+    stats() - вернуть словарь с метриками очереди.
+    Длина очереди, задержка доставки и результаты отправки также
+    учитываются в метриках (metrics.SEND_*).
+    """
+    # число последних замеров для расчета перцентилей задержки
+    LATENCY_WINDOW = 1000
+
+    def __init__(self, bot, workers=4, chat_rate=1.0, chat_burst=5,
+                 global_rate=30.0, global_burst=30, max_retries=5,
+                 backoff=1.0):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self._buckets = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._latencies = collections.deque(maxlen=self.LATENCY_WINDOW)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.throttled = 0
+
+    def _ready_queue(self):
+        raise NotImplementedError
+
+    def _notify_idle(self):
+        pass
+
+    def put(self, user_id, reply):
+        with self._lock:
+            self._depth += 1
+            metrics.SEND_QUEUE_DEPTH.set(self._depth)
+            chat_queue = self._pending.get(user_id)
+            if chat_queue is not None:
+                chat_queue.append((reply, time.monotonic()))
+                return
+            self._pending[user_id] = collections.deque(
+                [(reply, time.monotonic())])
+        self._ready_queue().put_nowait(user_id)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            result = {
+                'queue_depth': self._depth,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'throttled': self.throttled
+            }
+        if latencies:
+            result['latency_p50'] = latencies[len(latencies) // 2]
+            result['latency_p99'] = latencies[
+                min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        return result
+
+    def _bucket(self, user_id):
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(
+                    self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _reserve(self, user_id):
+        # время ожидания до отправки с учетом обоих ограничителей
+        return max(self._bucket(user_id).reserve(),
+                   self.global_bucket.reserve())
+
+    def _next_reply(self, user_id):
+        with self._lock:
+            return self._pending[user_id][0]
+
+    def _finish(self, user_id, delivered, queued_at):
+        with self._lock:
+            if delivered:
+                self.sent += 1
+                latency = time.monotonic() - queued_at
+                self._latencies.append(latency)
+                metrics.SEND_LATENCY_SECONDS.observe(latency)
+                metrics.SEND_RESULTS.inc('sent')
+            else:
+                self.failed += 1
+                metrics.SEND_RESULTS.inc('failed')
+            chat_queue = self._pending[user_id]
+            chat_queue.popleft()
+            if chat_queue:
+                self._ready_queue().put_nowait(user_id)
+            else:
+                del self._pending[user_id]
+                self._drop_full_bucket(user_id)
+            self._depth -= 1
+            metrics.SEND_QUEUE_DEPTH.set(self._depth)
+            if not self._depth:
+                self._notify_idle()
+
+    def _drop_full_bucket(self, user_id):
+        # полностью восстановившаяся корзина ничего не ограничивает,
+        # поэтому ее можно удалить, чтобы не хранить все чаты
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            return
+        elapsed = time.monotonic() - bucket.updated
+        if bucket.tokens + elapsed * bucket.rate >= bucket.capacity:
+            del self._buckets[user_id]
+
+    def _check_response(self, user_id, response, delay):
+        """
+        Разбирает результат попытки отправки (response равен None при
+        ошибке сокета).
+
+        Возвращает тройку (результат, пауза, следующая пауза): результат
+        True - сообщение доставлено, False - отклонено без повторов,
+        None - нужен повтор после паузы.
+        """
+        if response is not None and 200 <= response.status <= 299:
+            return True, 0, delay
+        if response is not None and response.status == 429:
+            with self._lock:
+                self.throttled += 1
+            metrics.SEND_RESULTS.inc('throttled')
+            return None, self._retry_after(response, delay), delay
+        if response is not None and response.status < 500:
+            logger.error('Сообщение для {0} отклонено: {1} {2}'.format(
+                user_id, response.status, response.reason))
+            return False, 0, delay
+        return None, delay, delay * 2
+
+    def _count_retry(self):
+        with self._lock:
+            self.retried += 1
+        metrics.SEND_RESULTS.inc('retried')
+
+    def _give_up(self, user_id):
+        logger.error('Сообщение для {0} не отправлено после {1} попыток'.format(
+            user_id, self.max_retries + 1))
+        return False
+
+    def _retry_after(self, response, default):
+        try:
+            data = decode_json(response.body)
+            return float(data['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            return default
+
+
+class SendQueue(BaseSendQueue):
+    """
+    Очередь исходящих сообщений с ограничением частоты отправки.
+
+    При инициализации принимает экземпляр Telebot и параметры
+    BaseSendQueue (workers - число потоков отправки).
+    Сообщения одному чату отправляются в порядке постановки в очередь,
+    сообщения разным чатам - параллельно. Ответ 429 от Telegram
+    приводит к паузе на указанное сервером время retry_after.
+    Имеет следующие публичные методы:
+    start() - запустить потоки отправки;
+    put(user_id, reply) - поставить сообщение в очередь;
+    join() - дождаться отправки всех сообщений;
+    stop() - отправить оставшиеся сообщения и остановить потоки;
+    stats() - вернуть словарь с метриками очереди.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._ready = queue.Queue()
+        self._idle = threading.Condition(self._lock)
+        self._threads = []
+
+    def _ready_queue(self):
+        return self._ready
+
+    def _notify_idle(self):
+        self._idle.notify_all()
+
+    def start(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self):
+        with self._idle:
+            while self._depth:
+                self._idle.wait()
+
+    def stop(self):
+        self.join()
+        for _ in self._threads:
+            self._ready.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            user_id = self._ready.get()
+            if user_id is None:
+                break
+            reply, queued_at = self._next_reply(user_id)
+            delivered = self._deliver(user_id, reply)
+            self._finish(user_id, delivered, queued_at)
+
+    def _deliver(self, user_id, reply):
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            wait = self._reserve(user_id)
+            if wait:
+                time.sleep(wait)
+            try:
+                response = self.bot.send_reply(user_id=user_id, reply=reply)
+            except socket.error:
+                response = None
+            result, pause, delay = self._check_response(
+                user_id, response, delay)
+            if result is not None:
+                return result
+            if attempt == self.max_retries:
+                break
+            self._count_retry()
+            time.sleep(pause)
+        return self._give_up(user_id)
+
+
+class AsyncSendQueue(BaseSendQueue):
+    """
+    Асинхронный вариант SendQueue для работы внутри asyncio.
+
+    При инициализации принимает экземпляр AsyncTelebot и параметры
+    BaseSendQueue (workers - число задач отправки). Порядок сообщений,
+    ограничения частоты и повторы те же, что у SendQueue; методы
+    start() и put() вызываются внутри цикла событий, join() и stop()
+    являются корутинами.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # очередь и событие создаются лениво, внутри цикла событий
+        self._ready = None
+        self._idle = None
+        self._tasks = []
+
+    def _ready_queue(self):
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+        return self._ready
+
+    def _idle_event(self):
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        return self._idle
+
+    def _notify_idle(self):
+        self._idle_event().set()
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.ensure_future(self._worker()))
+
+    async def join(self):
+        while self._depth:
+            self._idle_event().clear()
+            await self._idle_event().wait()
+
+    async def stop(self):
+        await self.join()
+        for _ in self._tasks:
+            self._ready_queue().put_nowait(None)
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            user_id = await self._ready_queue().get()
+            if user_id is None:
+                break
+            reply, queued_at = self._next_reply(user_id)
+            delivered = await self._deliver(user_id, reply)
+            self._finish(user_id, delivered, queued_at)
+
+    async def _deliver(self, user_id, reply):
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            wait = self._reserve(user_id)
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                response = await self.bot.send_reply(
+                    user_id=user_id, reply=reply)
+            except socket.error:
+                response = None
+            result, pause, delay = self._check_response(
+                user_id, response, delay)
+            if result is not None:
+                return result
+            if attempt == self.max_retries:
+                break
+            self._count_retry()
+            await asyncio.sleep(pause)
+        return self._give_up(user_id)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from contextlib import contextmanager
+import datetime
+import logging
+import re
+import sqlite3
+import threading
+
+from storage import StorageBackend
+from tables import MIGRATIONS, TABLES
+
+
+logger = logging.getLogger(__name__)
+
+
+# даты хранятся строками в формате DATETIME MySQL
+sqlite3.register_adapter(
+    datetime.datetime, lambda value: value.isoformat(' '))
+
+AUTO_INCREMENT_RE = re.compile(
+    r'\w*INT\s+(UNSIGNED\s+)?NOT NULL PRIMARY KEY AUTO_INCREMENT', re.I)
+UNIQUE_KEY_RE = re.compile(r'UNIQUE KEY \w+\s*\(', re.I)
+ADD_INDEX_RE = re.compile(
+    r'ADD (UNIQUE )?INDEX (\w+)\s*(\(.*\))', re.I | re.S)
+
+
+def sqlite_statements(statement):
+    """
+    Переводит SQL-запрос схемы MySQL из tables.py на диалект SQLite.
+
+    Возвращает список запросов (возможно, пустой, если запрос не
+    имеет смысла для SQLite).
+    """
+    statement = statement.strip().rstrip(';')
+    upper = statement.upper()
+    if 'FULLTEXT' in upper:
+        # поиск в SQLite идет по инвертированному индексу в памяти
+        return []
+    if upper.startswith('DELETE ') and not upper.startswith('DELETE FROM'):
+        # многотабличный DELETE объединяет дубликаты тэгов в старых
+        # базах MySQL; база SQLite создается сразу с новой схемой
+        return []
+    if upper.startswith('ALTER TABLE') and 'FOREIGN KEY' in upper:
+        # SQLite не умеет добавлять внешние ключи к существующей таблице
+        return []
+    if upper.startswith('INSERT IGNORE'):
+        return ['INSERT OR IGNORE' + statement[len('INSERT IGNORE'):]]
+    if upper.startswith('ALTER TABLE') and ', ADD ' in upper:
+        # SQLite выполняет только одно изменение за ALTER TABLE,
+        # индексы создаются отдельными запросами
+        table = statement.split()[2]
+        result = []
+        for clause in re.split(r',\s*ADD ', statement[len('ALTER TABLE ') +
+                                                        len(table) + 1:]):
+            if not clause.upper().startswith('ADD '):
+                clause = 'ADD ' + clause
+            match = ADD_INDEX_RE.match(clause)
+            if match is None:
+                result.append('ALTER TABLE {0} {1}'.format(table, clause))
+                continue
+            result.append('CREATE {0}INDEX {1} ON {2} {3}'.format(
+                match.group(1) or '', match.group(2), table, match.group(3)))
+        return result
+    statement = AUTO_INCREMENT_RE.sub(
+        'INTEGER PRIMARY KEY AUTOINCREMENT', statement)
+    statement = UNIQUE_KEY_RE.sub('UNIQUE (', statement)
+    statement = re.sub(r'\s+UNSIGNED', '', statement, flags=re.I)
+    # строки в MySQL по умолчанию сравниваются без учета регистра
+    statement = re.sub(r'(VARCHAR\(\d+\))', r'\1 COLLATE NOCASE', statement,
+                       flags=re.I)
+    return [statement]
+
+
+class SqliteStorage(StorageBackend):
+    """
+    Хранилище заметок во встроенной базе SQLite.
+
+    При инициализации принимает путь к файлу базы (path) и аргументы
+    кэшей StorageBackend. Не требует сервера СУБД и подходит для
+    небольших установок и бенчмарков.
+    База работает в режиме журнала WAL: читатели не блокируют
+    писателя, а фиксация транзакции с synchronous=NORMAL (SYNCHRONOUS)
+    не ждет сброса журнала на диск. Каждый поток использует собственное
+    соединение; подготовленные выражения кэшируются соединением.
+    Схема строится из tables.TABLES и tables.MIGRATIONS переводом
+    запросов на диалект SQLite (см. sqlite_statements).
+    Кроме команд StorageBackend имеет следующие методы:
+    open_connection() - открывает соединение текущего потока;
+    close_connection() - закрывает соединения всех потоков;
+    create_tables(seq) - создает таблицы (по умолчанию tables.TABLES);
+    migrate() - применяет недостающие миграции схемы.
+    """
+    # время ожидания блокировки базы другим писателем в секундах
+    BUSY_TIMEOUT = 30
+    # число подготовленных выражений в кэше каждого соединения
+    CACHED_STATEMENTS = 256
+    # режим сброса журнала на диск (PRAGMA synchronous)
+    SYNCHRONOUS = 'NORMAL'
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, path, tag_cache_ttl=None, message_cache_entries=10000,
+                 message_cache_bytes=16 * 1024 * 1024, compression=None,
+                 compress_threshold=StorageBackend.COMPRESS_THRESHOLD):
+        super().__init__(tag_cache_ttl, message_cache_entries,
+                         message_cache_bytes, compression, compress_threshold)
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._queries = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        cnx = sqlite3.connect(
+            self.path,
+            timeout=self.BUSY_TIMEOUT,
+            cached_statements=self.CACHED_STATEMENTS,
+            check_same_thread=False
+        )
+        cnx.execute('PRAGMA journal_mode=WAL;')
+        cnx.execute('PRAGMA synchronous={0};'.format(self.SYNCHRONOUS))
+        cnx.execute('PRAGMA foreign_keys=ON;')
+        with self._lock:
+            self._connections.append(cnx)
+        return cnx
+
+    def open_connection(self):
+        if getattr(self._local, 'cnx', None) is None:
+            self._local.cnx = self._connect()
+
+    def close_connection(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for cnx in connections:
+            cnx.close()
+        self._local = threading.local()
+
+    @contextmanager
+    def _connection(self):
+        self.open_connection()
+        yield self._local.cnx
+
+    def _translate(self, query):
+        # переведенные запросы запоминаются, поэтому текст запроса
+        # каждый раз совпадает и SQLite берет подготовленное выражение
+        # из кэша соединения (cached_statements) вместо повторного разбора
+        translated = self._queries.get(query)
+        if translated is None:
+            translated = query.replace('%s', '?')
+            self._queries[query] = translated
+        return translated
+
+    def _is_duplicate(self, err):
+        return 'UNIQUE constraint failed' in str(err)
+
+    def _execute_schema(self, cnx, statements):
+        for statement in statements:
+            for translated in sqlite_statements(statement):
+                cnx.execute(translated)
+
+    def create_tables(self, *tables):
+        with self._connection() as cnx:
+            exists = cnx.execute(
+                "SELECT 1 FROM sqlite_master "
+                "WHERE type='table' AND name='messages';"
+            ).fetchone()
+            if exists is None:
+                self._execute_schema(cnx, tables or TABLES)
+                cnx.commit()
+
+    def migrate(self, migrations=MIGRATIONS):
+        """
+        Применяет к базе данных миграции схемы, которые еще не применены
+        (аналогично DbConnector.migrate()).
+        """
+        with self._connection() as cnx:
+            cnx.execute(
+                'CREATE TABLE IF NOT EXISTS schema_version ('
+                '    version INTEGER NOT NULL'
+                ');'
+            )
+            current = cnx.execute(
+                'SELECT MAX(version) FROM schema_version;').fetchone()[0] or 0
+            for version, statements in migrations:
+                if version <= current:
+                    continue
+                logger.info('Применение миграции {0}'.format(version))
+                self._execute_schema(cnx, statements)
+                cnx.execute('DELETE FROM schema_version;')
+                cnx.execute(
+                    'INSERT INTO schema_version (version) VALUES (?);',
+                    (version,)
+                )
+                cnx.commit()
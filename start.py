@@ -1,16 +1,93 @@
+import logging
 import os
-from time import sleep
+from time import perf_counter, sleep
 
-from bot import Telebot, parse_data
+from archive import Archive
+from bot import Telebot, build_replies, parse_data
 from db_connector import DbConnector, DB
+from log_config import setup_logging
+import metrics
+from offset_store import FileOffsetStore
+from send_queue import SendQueue
+from sqlite_storage import SqliteStorage
+from write_buffer import WriteBuffer
 
 
-def main():
-    bot = Telebot(os.environ.get('BOT_ID'))
-    DB['database'] = os.environ.get('DB_NAME')
-    conn = DbConnector(**DB)
+logger = logging.getLogger(__name__)
+
+# пауза перед повторным запросом после ошибки API Telegram
+ERROR_DELAY = 5
+# число потоков, отправляющих ответы пользователям
+SEND_WORKERS = 4
+# размер пула соединений с базой данных
+DB_POOL_SIZE = 4
+# файл, в котором хранится смещение getUpdates между перезапусками
+OFFSET_FILE = os.environ.get('OFFSET_FILE', 'bot_offset')
+# хранилище заметок: mysql (по умолчанию) или sqlite
+STORAGE = os.environ.get('STORAGE', 'mysql')
+# файл базы данных для хранилища sqlite
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'bot.sqlite3')
+# сжатие больших заметок: zlib, zstd или пусто (без сжатия) и
+# минимальный размер сжимаемой заметки в байтах
+NOTE_COMPRESSION = {
+    'compression': os.environ.get('NOTE_COMPRESSION') or None,
+    'compress_threshold': int(os.environ.get(
+        'NOTE_COMPRESS_THRESHOLD', SqliteStorage.COMPRESS_THRESHOLD))
+}
+# порт HTTP-сервера метрик и профилирования (не запускается, если не задан)
+METRICS_PORT = os.environ.get('METRICS_PORT')
+# адрес сервера API Telegram (можно заменить тестовым сервером)
+TELEGRAM_API = {
+    'host': os.environ.get('TELEGRAM_API_HOST', Telebot.HOST),
+    'port': int(os.environ.get('TELEGRAM_API_PORT', Telebot.PORT)),
+    'use_tls': os.environ.get('TELEGRAM_API_TLS', '1') != '0'
+}
+
+
+def create_storage(pool_size=None, tag_cache_ttl=None):
+    """
+    Создает хранилище заметок, выбранное переменной окружения STORAGE,
+    и открывает соединение с ним.
+
+    tag_cache_ttl - время жизни кэша тэгов в секундах; задается, когда
+    тэги могут изменять другие процессы бота.
+    """
+    if STORAGE == 'sqlite':
+        conn = SqliteStorage(SQLITE_PATH, tag_cache_ttl=tag_cache_ttl,
+                             **NOTE_COMPRESSION)
+    else:
+        DB['database'] = os.environ.get('DB_NAME')
+        conn = DbConnector(pool_size=pool_size, tag_cache_ttl=tag_cache_ttl,
+                           **DB, **NOTE_COMPRESSION)
+    conn.open_connection()
+    return conn
+
+
+def start_metrics_server(port_offset=0):
+    """
+    Запускает сервер метрик, если задана переменная окружения
+    METRICS_PORT, и возвращает его (иначе None).
 
-    COMMANDS = {
+    Сервер слушает порт METRICS_PORT + port_offset, чтобы у каждого
+    процесса бота был свой порт.
+    """
+    if not METRICS_PORT:
+        return None
+    server = metrics.MetricsServer(
+        os.environ.get('METRICS_HOST', '127.0.0.1'),
+        int(METRICS_PORT) + port_offset)
+    server.start()
+    return server
+
+
+def get_commands(conn, bot=None):
+    """
+    Возвращает словарь соответствия команд бота методам хранилища заметок.
+
+    Если передан синхронный Telebot, добавляются команды /export
+    и /import, которые передают файлы архива через него.
+    """
+    commands = {
         'start': conn.add_user,
         'read_last': conn.read_last,
         'read': conn.read,
@@ -19,25 +96,125 @@ def main():
         'write': conn.write,
         'write_tag': conn.write_tag,
         'tag': conn.tag,
-        'tag_all': conn.tag_all
+        'tag_all': conn.tag_all,
+        'search': conn.search
     }
+    if bot is not None:
+        archive = Archive(bot, conn)
+        commands['export'] = archive.export
+        commands['import'] = archive.import_archive
+    return commands
+
+
+def execute(commands_map, command):
+    """
+    Выполняет команду и возвращает генератор сообщений ответа
+    пользователю.
+
+    Строки результата упаковываются в минимальное число сообщений;
+    если команда возвращает генератор, сообщения формируются по мере
+    чтения результата из базы.
+    """
+    if command.text not in commands_map:
+        return
+    # время команды учитывается в метриках вместе с чтением результата
+    with metrics.command_timer(command.text):
+        result = commands_map[command.text](**command.params)
+        if result:
+            yield from build_replies(result)
+
+
+def execute_batch(commands_map, write_buffer, commands):
+    """
+    Выполняет пакет команд и возвращает генератор пар (id пользователя,
+    сообщение ответа).
+
+    Команды /write накапливаются в буфере отложенной записи и
+    сохраняются одной транзакцией; перед выполнением любой другой
+    команды буфер записывается в базу, поэтому порядок команд и
+    ответов сохраняется.
+    Ошибка одной команды записывается в журнал и не прерывает
+    выполнение остальных команд пакета.
+    """
+    pending = []
+
+    def flush():
+        write_buffer.flush()
+        for user_id, future, started in pending:
+            try:
+                reply = future.result()
+            except Exception as err:
+                metrics.COMMAND_ERRORS.inc('write')
+                # подробности ошибки уже записал WriteBuffer
+                logger.warning('Заметка пользователя %s не сохранена: %s',
+                               user_id, err)
+                continue
+            finally:
+                metrics.COMMAND_SECONDS.observe(
+                    perf_counter() - started, 'write')
+            yield user_id, reply
+        del pending[:]
+
+    for command in commands:
+        if command.text == 'write':
+            pending.append((command.user_id,
+                            write_buffer.submit(**command.params),
+                            perf_counter()))
+            continue
+        for item in flush():
+            yield item
+        try:
+            for reply in execute(commands_map, command):
+                yield command.user_id, reply
+        except Exception as err:
+            logger.error(err, exc_info=True)
+    for item in flush():
+        yield item
+
+
+def run(bot, conn, send_queue=None, stop_event=None):
+    """
+    Получает обновления и выполняет команды, пока процесс не будет
+    остановлен или не будет установлено событие stop_event
+    (threading.Event).
+
+    Принимает экземпляр Telebot, хранилище заметок и (опционально)
+    очередь отправки ответов; если очередь не передана, создается
+    очередь с ограничениями частоты по умолчанию.
+    """
+    COMMANDS = get_commands(conn, bot)
+    if send_queue is None:
+        send_queue = SendQueue(bot, workers=SEND_WORKERS)
+    send_queue.start()
+    write_buffer = WriteBuffer(conn)
     
-    while True:
+    while stop_event is None or not stop_event.is_set():
         data = bot.check_updates()
-        commands = parse_data(data)
-        if len(commands) == 0:
+        if not data.get('ok'):
+            sleep(ERROR_DELAY)
             continue
-        conn.open_connection()
-        for command in commands:
-            if command.text in COMMANDS:
-                result = COMMANDS[command.text](**command.params)
-                if result:
-                    replies = result.split('%0A')
-                    for reply in replies:
-                        bot.send_reply(user_id=command.user_id, reply=reply)
-        conn.close_connection()
-            
-        sleep(10)
+        commands = parse_data(data)
+        for user_id, reply in execute_batch(COMMANDS, write_buffer, commands):
+            send_queue.put(user_id, reply)
+        # смещение сохраняется только после выполнения всего пакета
+        # и отправки всех ответов на него
+        send_queue.join()
+        bot.commit_offset()
+    send_queue.stop()
+
+
+def main():
+    setup_logging()
+    # отдельное соединение для long polling и по одному на поток отправки
+    bot = Telebot(
+        os.environ.get('BOT_ID'),
+        pool_size=SEND_WORKERS + 1,
+        auto_commit=False,
+        offset_store=FileOffsetStore(OFFSET_FILE),
+        **TELEGRAM_API
+    )
+    start_metrics_server()
+    run(bot, create_storage(DB_POOL_SIZE))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
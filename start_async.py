@@ -0,0 +1,86 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from bot import AsyncTelebot, Telebot, parse_data
+from dispatcher import Dispatcher
+from log_config import setup_logging
+from offset_store import FileOffsetStore
+from send_queue import AsyncSendQueue
+from start import (
+    ERROR_DELAY, OFFSET_FILE, SEND_WORKERS, TELEGRAM_API, create_storage,
+    execute, get_commands, start_metrics_server
+)
+
+
+# число потоков для блокирующих запросов к базе данных
+DB_THREADS = 8
+MAX_IN_FLIGHT = 32
+
+
+async def run(bot, conn, send_queue=None):
+    """
+    Получает обновления и выполняет команды разных пользователей
+    параллельно, пока задача не будет отменена.
+
+    Принимает экземпляр AsyncTelebot, хранилище заметок и
+    (опционально) очередь отправки ответов AsyncSendQueue; если
+    очередь не передана, создается очередь с ограничениями частоты
+    по умолчанию. Соединения с хранилищем закрываются при завершении.
+    Смещение getUpdates подтверждается только после выполнения всех
+    команд пакета и отправки ответов на них.
+    Файлы команд /export и /import передаются из потоков executor
+    синхронным Telebot с отдельным соединением.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=DB_THREADS)
+    file_bot = Telebot(bot.id, pool_size=1, host=bot.host, port=bot.port,
+                       use_tls=bot.use_tls)
+    commands = get_commands(conn, file_bot)
+    if send_queue is None:
+        send_queue = AsyncSendQueue(bot, workers=SEND_WORKERS)
+    send_queue.start()
+
+    def run_command(command):
+        return list(execute(commands, command))
+
+    async def handle(command):
+        replies = await loop.run_in_executor(executor, run_command, command)
+        for reply in replies:
+            send_queue.put(command.user_id, reply)
+
+    dispatcher = Dispatcher(handle, max_in_flight=MAX_IN_FLIGHT)
+    try:
+        while True:
+            data = await bot.check_updates()
+            if not data.get('ok'):
+                await asyncio.sleep(ERROR_DELAY)
+                continue
+            for command in parse_data(data):
+                dispatcher.submit(command)
+            await dispatcher.join()
+            await send_queue.join()
+            bot.commit_offset()
+    finally:
+        await dispatcher.join()
+        await send_queue.stop()
+        executor.shutdown()
+        conn.close_connection()
+        file_bot.close()
+        bot.close()
+
+
+async def main():
+    setup_logging()
+    bot = AsyncTelebot(
+        os.environ.get('BOT_ID'),
+        auto_commit=False,
+        offset_store=FileOffsetStore(OFFSET_FILE),
+        **TELEGRAM_API
+    )
+    start_metrics_server()
+    # каждый поток берет собственное соединение из пула
+    await run(bot, create_storage(DB_THREADS))
+
+if __name__ == '__main__':
+    asyncio.run(main())
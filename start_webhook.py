@@ -0,0 +1,51 @@
+import multiprocessing
+import os
+
+from bot import Telebot
+from log_config import setup_logging
+from start import TELEGRAM_API, start_metrics_server
+from supervisor import WORKERS, WorkerPool
+from webhook import WebhookServer
+
+
+# число потоков, передающих команды рабочим процессам
+WEBHOOK_WORKERS = 4
+# максимальное число команд в очереди одного потока и одного процесса
+WEBHOOK_QUEUE_SIZE = 1000
+
+
+def main():
+    # один процесс принимает обновления и раздает команды рабочим
+    # процессам по user_id, как supervisor.py
+    log_queue = multiprocessing.Queue()
+    setup_logging(log_queue)
+    pool = WorkerPool(workers=WORKERS, log_queue=log_queue,
+                      queue_size=WEBHOOK_QUEUE_SIZE, acks=False)
+    pool.start()
+    bot = Telebot(os.environ.get('BOT_ID'), pool_size=1, **TELEGRAM_API)
+
+    secret_token = os.environ.get('WEBHOOK_SECRET')
+    server = WebhookServer(
+        pool.submit,
+        port=int(os.environ.get('WEBHOOK_PORT', 8443)),
+        path=os.environ.get('WEBHOOK_PATH', '/'),
+        secret_token=secret_token,
+        workers=WEBHOOK_WORKERS,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        certfile=os.environ.get('WEBHOOK_CERT'),
+        keyfile=os.environ.get('WEBHOOK_KEY')
+    )
+    webhook_url = os.environ.get('WEBHOOK_URL')
+    if webhook_url:
+        bot.set_webhook(webhook_url, secret_token)
+    server.start()
+    start_metrics_server()
+    try:
+        server.serve_forever()
+    finally:
+        server.stop()
+        pool.stop()
+        bot.close()
+
+if __name__ == '__main__':
+    main()
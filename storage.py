@@ -0,0 +1,852 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import hashlib
+import logging
+import random
+import threading
+import time
+
+from cache import MessageCache, TagCache
+import metrics
+import note_compression
+from search_index import InvertedIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Cursor:
+    """
+    Курсор DB-API, переводящий запросы на диалект хранилища и
+    учитывающий время их выполнения в метриках.
+    """
+    def __init__(self, cursor, translate):
+        self.cursor = cursor
+        self.translate = translate
+
+    def _run(self, method, query, params):
+        name = metrics.query_name(query)
+        started = time.perf_counter()
+        try:
+            if params is None:
+                method(self.translate(query))
+            else:
+                method(self.translate(query), params)
+        except Exception:
+            metrics.DB_QUERY_ERRORS.inc(name)
+            raise
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(
+                time.perf_counter() - started, name)
+        return self
+
+    def execute(self, query, params=None):
+        return self._run(self.cursor.execute, query, params)
+
+    def executemany(self, query, seq_of_params):
+        return self._run(self.cursor.executemany, query, seq_of_params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.cursor)
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    def close(self):
+        self.cursor.close()
+
+
+class StorageBackend:
+    """
+    Общая часть хранилищ заметок, не зависящая от СУБД.
+
+    Конкретное хранилище (DbConnector для MySQL, SqliteStorage для
+    SQLite) реализует соединения и схему:
+    open_connection(), close_connection(), _connection() - контекстный
+    менеджер, выдающий соединение DB-API на время одной команды,
+    create_tables(*tables), migrate(), а также IntegrityError и
+    _is_duplicate(err) для распознавания нарушения уникальности.
+    Запросы записываются с плейсхолдерами %s; хранилище с другим
+    стилем плейсхолдеров переопределяет _translate(query).
+    Время выполнения каждого запроса учитывается в метриках
+    (metrics.DB_QUERY_SECONDS).
+
+    При инициализации принимает аргументы tag_cache_ttl,
+    message_cache_entries, message_cache_bytes, compression и
+    compress_threshold (см. ниже).
+    Имеет следующие публичные методы:
+    add_user(user_id) - добавляет нового пользователя в базу
+    tag(seq) - принимет последовательность строк с именами тэгов
+               и возвращает список строк с их описанием;
+    write(date, text, user_id, tags_names, update_id) - 
+               добавляет новое сообщение в базу. Принимает дату, 
+               текст, id пользователя, имена тегов, связанных с ним,
+               и id обновления Telegram (повторная запись с тем же
+               update_id не создает новую заметку).
+               Возвращает строку с уведомлением о сохранении сообщения 
+               и его id;
+    write_many(notes) - записывает несколько заметок одной
+                        транзакцией (см. write);
+    write_tag(name, definition) - добавляет новый тэг;
+    read_last(usеr_id) - принимет id пользователя и возвращает
+                         последнее сохраненное сообщение от него;
+    read(user_id, message_id) - принимет id пользователя и id сообщения
+                                и возвращает последнее сохраненное 
+                                сообщение от него;
+    read_all(user_id, page) - принимет id пользователя и возвращает
+                              генератор всех его сообщений, читаемых
+                              из базы постранично; если указан номер
+                              страницы page, возвращает список
+                              сообщений этой страницы;
+    read_tag(user_id, tag_name, page) - принимет id пользователя и имя
+                                        тега и возвращает его
+                                        сообщения, связанные с
+                                        указанным тегом (аналогично
+                                        read_all);
+    tag_all()  - возвращает список всех имеющихся в базе тэгов;
+    search(user_id, query) - принимает id пользователя и поисковый
+                             запрос и возвращает список наиболее
+                             релевантных заметок пользователя;
+    compress_notes(batch_size) - сжимает ранее записанные заметки
+                                 (см. ниже), возвращает число сжатых;
+    export_tags(user_id) - возвращает список пар (имя, описание)
+                           тэгов, связанных с заметками пользователя;
+    export_notes(user_id) - возвращает генератор словарей с ключами
+                            date, text и tags (имена тэгов) всех
+                            заметок пользователя, читаемых из базы
+                            постранично;
+    import_notes(user_id, tags, notes) - добавляет недостающие тэги
+                                         и записывает заметки пакетами
+                                         (см. write_many), не меняя
+                                         последнюю заметку
+                                         пользователя; возвращает
+                                         число записанных заметок.
+
+    Справочник тэгов загружается в память при первом обращении и
+    обновляется при write_tag(); аргумент tag_cache_ttl задает время
+    жизни кэша в секундах, после которого тэги перечитываются из базы.
+    Недавно записанные и прочитанные заметки хранятся в LRU-кэше
+    message_cache (не более message_cache_entries записей и
+    message_cache_bytes байт), поэтому повторные read_last() и read()
+    не обращаются к базе.
+    Если хранилище не поддерживает полнотекстовый поиск (fulltext
+    равен False), для пользователя строится инвертированный индекс
+    в памяти; хранятся индексы не более SEARCH_INDEXES недавно
+    искавших пользователей.
+    Если задан метод сжатия compression ('zlib' или 'zstd'), текст
+    заметки длиной не меньше compress_threshold байт (в UTF-8)
+    хранится сжатым в колонке body, а колонка compression содержит
+    метод сжатия; колонка text такой заметки пуста. Заметки,
+    записанные до включения сжатия, сжимает compress_notes().
+    Методы чтения распаковывают заметки сами и возвращают текст
+    без URL-экранирования (его выполняет transport.encode_query).
+    """
+    # число заметок, читаемых из базы за один запрос
+    PAGE_SIZE = 100
+    # число строк в одном многострочном INSERT
+    INSERT_ROWS = 100
+    # максимальное число заметок в результате поиска
+    SEARCH_LIMIT = 20
+    # число инвертированных индексов пользователей в памяти
+    SEARCH_INDEXES = 100
+    # минимальный размер сжимаемой заметки в байтах
+    COMPRESS_THRESHOLD = 1024
+    # исключение DB-API, которым СУБД сообщает о нарушении ограничений
+    IntegrityError = None
+
+    def __init__(self, tag_cache_ttl=None, message_cache_entries=10000,
+                 message_cache_bytes=16 * 1024 * 1024, compression=None,
+                 compress_threshold=COMPRESS_THRESHOLD):
+        self.tag_cache = TagCache(tag_cache_ttl)
+        self.message_cache = MessageCache(
+            message_cache_entries, message_cache_bytes)
+        self.compression = note_compression.method_id(compression)
+        self.compress_threshold = compress_threshold
+        # источник временных ключей import_key; не зависит от состояния,
+        # унаследованного дочерними процессами при fork
+        self._random = random.SystemRandom()
+        self.fulltext = False
+        self.search_indexes = OrderedDict()
+        # общая блокировка защищает только словари индексов и
+        # блокировок, индекс каждого пользователя строится под своей
+        self._search_lock = threading.Lock()
+        self._build_locks = {}
+
+    def open_connection(self):
+        raise NotImplementedError
+
+    def close_connection(self):
+        raise NotImplementedError
+
+    def _connection(self):
+        raise NotImplementedError
+
+    def _cursor(self, cnx):
+        return _Cursor(cnx.cursor(), self._translate)
+
+    def _translate(self, query):
+        return query
+
+    def _is_duplicate(self, err):
+        raise NotImplementedError
+
+    def _fulltext_search(self, user_id, query, limit):
+        # None означает, что нужно искать по индексу в памяти
+        return None
+
+    def _encode_note(self, text):
+        """
+        Возвращает значения колонок (text, body, compression) заметки.
+        """
+        if self.compression == note_compression.NONE:
+            return text, None, note_compression.NONE
+        data = text.encode('utf-8')
+        if len(data) < self.compress_threshold:
+            return text, None, note_compression.NONE
+        body = note_compression.compress(data, self.compression)
+        if len(body) >= len(data):
+            return text, None, note_compression.NONE
+        return u'', body, self.compression
+
+    def _note_text(self, text, body, compression):
+        if compression == note_compression.NONE:
+            return text
+        return note_compression.decompress(
+            bytes(body), compression).decode('utf-8')
+
+    def add_user(self, user_id, date):
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            check_user_exists = (
+                'SELECT count(*) FROM users '
+                'WHERE id=%s;'
+            )
+            cursor.execute(check_user_exists, (user_id,))
+            count = int(next(cursor)[0])
+            if count != 0:
+                cursor.close()
+                return
+            add_user = (
+                'INSERT INTO users (id, first_addressing) '
+                'VALUES '
+                '    (%s, %s);'
+            )
+            cursor.execute(add_user, (user_id, date))
+            cnx.commit()
+            cursor.close()
+
+    def _load_tags(self, cnx=None):
+        if self.tag_cache.is_loaded():
+            return
+        if cnx is None:
+            with self._connection() as cnx:
+                self._load_tags(cnx)
+            return
+        cursor = self._cursor(cnx)
+        cursor.execute('SELECT id, name, definition FROM tags;')
+        self.tag_cache.load(cursor.fetchall())
+        cursor.close()
+
+    def _unknown_tags(self, tags_names):
+        # имена, которых нет в кэше ни среди тэгов, ни среди
+        # отсутствующих в базе
+        return dict((name.lower(), name) for name in tags_names
+                    if self.tag_cache.get(name) is None
+                    and not self.tag_cache.is_missing(name))
+
+    def _find_tags(self, tags_names, cnx=None):
+        """
+        Возвращает список кортежей (id, name, definition) найденных
+        тэгов в порядке tags_names.
+
+        Тэги, которых нет в кэше, ищутся в базе одним запросом: их мог
+        добавить другой процесс после загрузки кэша. Ненайденные имена
+        кэш помнит до истечения времени жизни или записи тэга, поэтому
+        повторный поиск неизвестного тэга не обращается к базе.
+        """
+        if cnx is None:
+            if (not self.tag_cache.is_loaded()
+                    or self._unknown_tags(tags_names)):
+                with self._connection() as cnx:
+                    return self._find_tags(tags_names, cnx)
+        else:
+            self._load_tags(cnx)
+            missing = self._unknown_tags(tags_names)
+            if missing:
+                cursor = self._cursor(cnx)
+                find_tags = (
+                    'SELECT id, name, definition FROM tags '
+                    'WHERE name IN ({0});'
+                ).format(', '.join(['%s'] * len(missing)))
+                cursor.execute(find_tags, tuple(missing.values()))
+                for tag_id, name, definition in cursor.fetchall():
+                    self.tag_cache.put(tag_id, name, definition)
+                    missing.pop(name.lower(), None)
+                cursor.close()
+                self.tag_cache.put_missing(missing)
+        result = []
+        for name in tags_names:
+            tag = self.tag_cache.get(name)
+            if tag is not None:
+                result.append(tag)
+        return result
+
+    def tag(self, tags_names):
+        return [u'#{0} - {1}'.format(name, definition)
+                for _, name, definition in self._find_tags(tags_names)]
+
+    def _find_by_update_id(self, cnx, update_ids):
+        return self._find_by_key(cnx, 'update_id', update_ids)
+
+    def _find_by_key(self, cnx, column, keys):
+        # column - update_id или import_key, оба с уникальным индексом
+        if not keys:
+            return {}
+        cursor = self._cursor(cnx)
+        find_messages = (
+            'SELECT {0}, id FROM messages '
+            'WHERE {0} IN ({1});'
+        ).format(column, ', '.join(['%s'] * len(keys)))
+        cursor.execute(find_messages, tuple(keys))
+        result = dict(cursor)
+        cursor.close()
+        return result
+
+    def _insert_rows(self, cursor, query, rows):
+        # многострочный INSERT: одна команда на INSERT_ROWS строк
+        # в любой СУБД (executemany в SQLite выполняет запрос
+        # для каждой строки)
+        values = '({0})'.format(', '.join(['%s'] * len(rows[0])))
+        for start in range(0, len(rows), self.INSERT_ROWS):
+            chunk = rows[start:start + self.INSERT_ROWS]
+            params = []
+            for row in chunk:
+                params.extend(row)
+            cursor.execute(
+                query.format(', '.join([values] * len(chunk))),
+                tuple(params))
+
+    def _insert_messages(self, cnx, notes, update_last=True):
+        """
+        Записывает заметки в базу одной транзакцией.
+
+        Возвращает список id заметок в порядке notes и список флагов,
+        была ли заметка записана сейчас. Заметки, чей update_id или
+        import_key (ключ импортированной заметки) уже есть в базе,
+        повторно не записываются. Если update_last равен False,
+        последняя заметка пользователя (users.last_message_id)
+        не меняется.
+        """
+        cursor = self._cursor(cnx)
+        update_ids = set(note['update_id'] for note in notes
+                         if note.get('update_id') is not None)
+        existing = self._find_by_update_id(cnx, update_ids)
+        imported = self._find_by_key(
+            cnx, 'import_key', set(note['import_key'] for note in notes
+                                   if note.get('import_key') is not None))
+        add_message = (
+            'INSERT INTO messages '
+            '    (date, text, body, compression, user_id, update_id, '
+            '     import_key) '
+            'VALUES {0};'
+        )
+        new_rows = {}
+        keyed_rows = {}
+        # заметки без update_id и import_key получают временный
+        # случайный ключ, по которому после многострочного INSERT
+        # находятся их id
+        temporary_keys = []
+        note_keys = []
+        for note in notes:
+            update_id = note.get('update_id')
+            if update_id is None:
+                import_key = note.get('import_key')
+                if import_key is None:
+                    import_key = self._random.getrandbits(62) + 1
+                    temporary_keys.append(import_key)
+                note_keys.append(import_key)
+                if import_key not in imported and import_key not in keyed_rows:
+                    keyed_rows[import_key] = (note['date'],) + (
+                        self._encode_note(note['text'])
+                        + (note['user_id'], None, import_key))
+            elif update_id not in existing and update_id not in new_rows:
+                # при повторе обновления в пакете записывается первая
+                # копия, как и в кэше и индексе поиска
+                new_rows[update_id] = (note['date'],) + self._encode_note(
+                    note['text']) + (note['user_id'], update_id, None)
+        if new_rows or keyed_rows:
+            self._insert_rows(
+                cursor, add_message,
+                list(new_rows.values()) + list(keyed_rows.values()))
+            existing.update(self._find_by_update_id(cnx, new_rows))
+            imported.update(self._find_by_key(cnx, 'import_key', keyed_rows))
+        if temporary_keys:
+            clear_keys = (
+                'UPDATE messages '
+                'SET import_key=NULL '
+                'WHERE id IN ({0});'
+            ).format(', '.join(['%s'] * len(temporary_keys)))
+            cursor.execute(clear_keys, tuple(
+                imported[import_key] for import_key in temporary_keys))
+        keys = iter(note_keys)
+        ids = []
+        fresh = []
+        for note in notes:
+            update_id = note.get('update_id')
+            if update_id is None:
+                import_key = next(keys)
+                ids.append(imported[import_key])
+                fresh.append(keyed_rows.pop(import_key, None) is not None)
+                continue
+            ids.append(existing[update_id])
+            # повтор того же обновления в пакете не считается новым
+            fresh.append(new_rows.pop(update_id, None) is not None)
+        # тэги всех новых заметок пакета находятся одним обращением
+        names = set()
+        for note, is_new in zip(notes, fresh):
+            if is_new:
+                names.update(note['tags_names'])
+        tag_ids = dict((name.lower(), tag_id)
+                       for tag_id, name, _ in self._find_tags(names, cnx))
+        last_ids = {}
+        tag_rows = set()
+        for note, message_id, is_new in zip(notes, ids, fresh):
+            if not is_new:
+                continue
+            last_ids[note['user_id']] = message_id
+            for name in note['tags_names']:
+                tag_id = tag_ids.get(name.lower())
+                if tag_id is not None:
+                    tag_rows.add((message_id, tag_id))
+        if last_ids and update_last:
+            add_last_message = (
+                'UPDATE users '
+                'SET last_message_id=CASE id {0} END '
+                'WHERE id IN ({1});'
+            ).format(
+                ' '.join(['WHEN %s THEN %s'] * len(last_ids)),
+                ', '.join(['%s'] * len(last_ids))
+            )
+            params = []
+            for user_id, message_id in last_ids.items():
+                params.extend((user_id, message_id))
+            params.extend(last_ids)
+            cursor.execute(add_last_message, tuple(params))
+        if tag_rows:
+            add_message_tag = (
+                'INSERT INTO messages_tags (message_id, tag_id) '
+                'VALUES {0};'
+            )
+            self._insert_rows(cursor, add_message_tag, sorted(tag_rows))
+        cursor.close()
+        return ids, fresh
+
+    def write_many(self, notes, update_last=True):
+        """
+        Записывает несколько заметок одной транзакцией.
+
+        Принимает список словарей с ключами date, text, user_id,
+        tags_names и (необязательно) update_id, возвращает список
+        уведомлений о сохранении в том же порядке. Если update_last
+        равен False (импорт архива), последняя заметка пользователя
+        не меняется и заметки не попадают в кэш.
+        """
+        if not notes:
+            return []
+        with self._connection() as cnx:
+            try:
+                try:
+                    ids, fresh = self._insert_messages(
+                        cnx, notes, update_last)
+                except self.IntegrityError as err:
+                    if not self._is_duplicate(err):
+                        raise
+                    # то же обновление одновременно записал другой
+                    # процесс (или совпал временный import_key)
+                    cnx.rollback()
+                    ids, fresh = self._insert_messages(
+                        cnx, notes, update_last)
+                cnx.commit()
+            except Exception:
+                # незавершенная транзакция не должна остаться открытой
+                # на соединении и попасть в следующую фиксацию
+                cnx.rollback()
+                raise
+        for note, message_id, is_new in zip(notes, ids, fresh):
+            if not is_new:
+                continue
+            user_id = note['user_id']
+            if update_last:
+                self.message_cache.put(user_id, message_id, note['text'])
+                self.message_cache.set_last(user_id, message_id)
+            with self._search_lock:
+                search_index = self.search_indexes.get(user_id)
+            if search_index is not None:
+                search_index.add(message_id, note['text'])
+        return [u'заметка {0} сохранена'.format(message_id)
+                for message_id in ids]
+
+    def write(self, date, text, user_id, tags_names, update_id=None):
+        return self.write_many([{
+            'date': date,
+            'text': text,
+            'user_id': user_id,
+            'tags_names': tags_names,
+            'update_id': update_id
+        }])[0]
+
+    def write_tag(self, tag_name, tag_definition):
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            find_tag = (
+                'SELECT id FROM tags '
+                'WHERE name=%s;'
+            )
+            cursor.execute(find_tag, (tag_name,))
+            try:
+                tag_id = next(cursor)[0]
+                update_tag = (
+                    'UPDATE tags '
+                    'SET definition=%s '
+                    'WHERE id=%s;'
+                )
+                cursor.execute(update_tag, (tag_definition, tag_id))
+            except StopIteration:
+                add_tag = (
+                    'INSERT INTO tags (name, definition) '
+                    'VALUES '
+                    '    (%s, %s);'
+                )
+                cursor.execute(add_tag, (tag_name, tag_definition))
+                tag_id = cursor.lastrowid
+            finally:
+                cnx.commit()
+                cursor.close()
+            self.tag_cache.put(tag_id, tag_name, tag_definition)
+
+    def read_last(self, user_id):
+        message_id = self.message_cache.get_last(user_id)
+        if message_id is not None:
+            text = self.message_cache.get(user_id, message_id)
+            if text is not None:
+                return text
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            text_query = (
+                'SELECT messages.id, text, body, compression FROM messages '
+                'JOIN users ON users.last_message_id=messages.id '
+                'WHERE users.id=%s;'
+            )
+            cursor.execute(text_query, (user_id,))
+            try:
+                message_id, text, body, compression = next(cursor)
+            except StopIteration:
+                return u''
+            cursor.close()
+            text = self._note_text(text, body, compression)
+            self.message_cache.put(user_id, message_id, text)
+            self.message_cache.set_last(user_id, message_id)
+            return text
+
+    def read(self, user_id, message_id):
+        text = self.message_cache.get(user_id, message_id)
+        if text is not None:
+            return text
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            text_query = (
+                'SELECT text, body, compression, user_id FROM messages '
+                'WHERE id=%s;'
+            )
+            cursor.execute(text_query, (message_id,))
+            try:
+                text, body, compression, owner_id = next(cursor)
+            except StopIteration:
+                cursor.close()
+                return u'заметка {0} не найдена'.format(message_id)
+            cursor.close()
+            if user_id == owner_id:
+                text = self._note_text(text, body, compression)
+                self.message_cache.put(user_id, message_id, text)
+                return text
+            return (u'заметка {0} принадлежит другому '
+                    u'пользователю').format(message_id)
+
+    def _read_page(self, query, params, after_id, page_size, offset=0):
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            cursor.execute(query, params + (after_id, page_size, offset))
+            rows = cursor.fetchall()
+            cursor.close()
+        # строки (id, text, body, compression) -> (id, текст заметки)
+        return [(row[0], self._note_text(*row[1:])) for row in rows]
+
+    def _iter_pages(self, query, params, page_size):
+        # keyset-пагинация: каждая страница начинается после последнего
+        # прочитанного id, соединение занято только на время запроса
+        after_id = 0
+        while True:
+            rows = self._read_page(query, params, after_id, page_size)
+            for _, text in rows:
+                yield text
+            if len(rows) < page_size:
+                break
+            after_id = rows[-1][0]
+
+    def _read(self, query, params, page, page_size):
+        if page is None:
+            return self._iter_pages(query, params, page_size)
+        rows = self._read_page(
+            query, params, 0, page_size, (page - 1) * page_size)
+        return [text for _, text in rows]
+
+    def read_all(self, user_id, page=None, page_size=PAGE_SIZE):
+        text_query = (
+            'SELECT id, text, body, compression FROM messages '
+            'WHERE user_id=%s AND id>%s '
+            'ORDER BY id '
+            'LIMIT %s OFFSET %s;'
+        )
+        return self._read(text_query, (user_id,), page, page_size)
+
+    def read_tag(self, user_id, tag_name, page=None, page_size=PAGE_SIZE):
+        tags = self._find_tags([tag_name])
+        if not tags:
+            return []
+        tag = tags[0]
+        text_query = (
+            'SELECT messages.id, text, body, compression FROM messages '
+            'JOIN messages_tags ON messages.id = messages_tags.message_id '
+            'WHERE user_id=%s AND messages_tags.tag_id=%s '
+            '    AND messages.id>%s '
+            'ORDER BY messages.id '
+            'LIMIT %s OFFSET %s;'
+        )
+        return self._read(text_query, (user_id, tag[0]), page, page_size)
+
+    def tag_all(self):
+        self._load_tags()
+        return [u'#{0}-{1}'.format(name, definition)
+                for _, name, definition in self.tag_cache.all()]
+
+    def _cached_index(self, user_id):
+        with self._search_lock:
+            search_index = self.search_indexes.get(user_id)
+            if search_index is not None:
+                self.search_indexes.move_to_end(user_id)
+            return search_index
+
+    def _search_index(self, user_id):
+        search_index = self._cached_index(user_id)
+        if search_index is not None:
+            return search_index
+        with self._search_lock:
+            build_lock = self._build_locks.setdefault(
+                user_id, threading.Lock())
+        with build_lock:
+            # индекс мог построить поток, ждавший той же блокировки
+            search_index = self._cached_index(user_id)
+            if search_index is not None:
+                return search_index
+            search_index = InvertedIndex()
+            text_query = (
+                'SELECT id, text, body, compression FROM messages '
+                'WHERE user_id=%s AND id>%s '
+                'ORDER BY id '
+                'LIMIT %s OFFSET %s;'
+            )
+            after_id = 0
+            while True:
+                rows = self._read_page(
+                    text_query, (user_id,), after_id, self.PAGE_SIZE)
+                for message_id, text in rows:
+                    search_index.add(message_id, text)
+                if len(rows) < self.PAGE_SIZE:
+                    break
+                after_id = rows[-1][0]
+            with self._search_lock:
+                self.search_indexes[user_id] = search_index
+                while len(self.search_indexes) > self.SEARCH_INDEXES:
+                    self.search_indexes.popitem(last=False)
+                self._build_locks.pop(user_id, None)
+            return search_index
+
+    def _index_search(self, user_id, query, limit):
+        ids = self._search_index(user_id).search(query, limit)
+        if not ids:
+            return []
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            text_query = (
+                'SELECT id, text, body, compression FROM messages '
+                'WHERE id IN ({0});'
+            ).format(', '.join(['%s'] * len(ids)))
+            cursor.execute(text_query, tuple(ids))
+            texts = {row[0]: self._note_text(*row[1:]) for row in cursor}
+            cursor.close()
+        return [(message_id, texts[message_id]) for message_id in ids
+                if message_id in texts]
+
+    def export_tags(self, user_id):
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            tags_query = (
+                'SELECT DISTINCT tags.name, tags.definition FROM tags '
+                'JOIN messages_tags ON tags.id = messages_tags.tag_id '
+                'JOIN messages ON messages.id = messages_tags.message_id '
+                'WHERE messages.user_id=%s '
+                'ORDER BY tags.name;'
+            )
+            cursor.execute(tags_query, (user_id,))
+            tags = cursor.fetchall()
+            cursor.close()
+        return tags
+
+    def _export_page(self, user_id, after_id, page_size):
+        with self._connection() as cnx:
+            cursor = self._cursor(cnx)
+            notes_query = (
+                'SELECT id, date, text, body, compression FROM messages '
+                'WHERE user_id=%s AND id>%s '
+                'ORDER BY id '
+                'LIMIT %s;'
+            )
+            cursor.execute(notes_query, (user_id, after_id, page_size))
+            rows = cursor.fetchall()
+            tags = {}
+            if rows:
+                tags_query = (
+                    'SELECT messages_tags.message_id, tags.name '
+                    'FROM messages_tags '
+                    'JOIN tags ON tags.id = messages_tags.tag_id '
+                    'WHERE messages_tags.message_id IN ({0});'
+                ).format(', '.join(['%s'] * len(rows)))
+                cursor.execute(tags_query, tuple(row[0] for row in rows))
+                for message_id, name in cursor:
+                    tags.setdefault(message_id, []).append(name)
+            cursor.close()
+        return rows, tags
+
+    def export_notes(self, user_id, page_size=PAGE_SIZE):
+        # keyset-пагинация, как в read_all: в памяти не больше одной
+        # страницы, соединение занято только на время ее чтения
+        after_id = 0
+        while True:
+            rows, tags = self._export_page(user_id, after_id, page_size)
+            for message_id, date, text, body, compression in rows:
+                yield {
+                    'date': date,
+                    'text': self._note_text(text, body, compression),
+                    'tags': sorted(tags.get(message_id, []))
+                }
+            if len(rows) < page_size:
+                break
+            after_id = rows[-1][0]
+
+    def _import_key(self, update_id, number):
+        # 62-битный ключ заметки с номером number из архива команды
+        # /import с данным update_id
+        digest = hashlib.blake2b(
+            '{0}:{1}'.format(update_id, number).encode('ascii'),
+            digest_size=8).digest()
+        return (int.from_bytes(digest, 'big') >> 2) + 1
+
+    def import_notes(self, user_id, tags, notes, batch_size=PAGE_SIZE,
+                     update_id=None):
+        """
+        Принимает итерируемые объекты пар (имя, описание) тэгов и
+        словарей с ключами date, text и tags. Тэги, уже имеющиеся
+        в базе, не изменяются; заметки записываются транзакциями по
+        batch_size заметок, поэтому notes может быть генератором
+        любой длины.
+        Если передан update_id команды /import, ключ каждой заметки
+        выводится из него и номера заметки в архиве: повтор того же
+        обновления после сбоя не записывает заметки второй раз.
+        """
+        tags = list(tags)
+        existing = self._find_tags([name for name, _ in tags])
+        existing = set(name.lower() for _, name, _ in existing)
+        for name, definition in tags:
+            if name.lower() not in existing:
+                self.write_tag(name, definition)
+        imported = 0
+        batch = []
+        for number, note in enumerate(notes):
+            batch.append({
+                'date': note['date'],
+                'text': note['text'],
+                'user_id': user_id,
+                'tags_names': note['tags'],
+                'import_key': (None if update_id is None
+                               else self._import_key(update_id, number))
+            })
+            if len(batch) >= batch_size:
+                imported += len(self.write_many(batch, update_last=False))
+                batch = []
+        imported += len(self.write_many(batch, update_last=False))
+        return imported
+
+    def search(self, user_id, query, limit=SEARCH_LIMIT):
+        if not query or not query.strip():
+            return []
+        rows = None
+        if self.fulltext:
+            rows = self._fulltext_search(user_id, query, limit)
+        if rows is None:
+            rows = self._index_search(user_id, query, limit)
+        return [u'{0}: {1}'.format(message_id, text)
+                for message_id, text in rows]
+
+    def compress_notes(self, batch_size=PAGE_SIZE):
+        """
+        Сжимает заметки, записанные без сжатия, если их размер не меньше
+        compress_threshold. Заметки обрабатываются пакетами по
+        batch_size, каждый пакет - отдельной транзакцией, поэтому
+        миграцию можно прервать и продолжить.
+        Возвращает число сжатых заметок.
+        """
+        if self.compression == note_compression.NONE:
+            return 0
+        text_query = (
+            'SELECT id, text FROM messages '
+            'WHERE compression=0 AND id>%s '
+            'ORDER BY id '
+            'LIMIT %s;'
+        )
+        update_message = (
+            'UPDATE messages '
+            'SET text=%s, body=%s, compression=%s '
+            'WHERE id=%s;'
+        )
+        compressed = 0
+        after_id = 0
+        while True:
+            with self._connection() as cnx:
+                cursor = self._cursor(cnx)
+                cursor.execute(text_query, (after_id, batch_size))
+                rows = cursor.fetchall()
+                updates = []
+                for message_id, text in rows:
+                    encoded = self._encode_note(text)
+                    if encoded[2] != note_compression.NONE:
+                        updates.append(encoded + (message_id,))
+                if updates:
+                    cursor.executemany(update_message, updates)
+                cnx.commit()
+                cursor.close()
+            compressed += len(updates)
+            if len(rows) < batch_size:
+                break
+            after_id = rows[-1][0]
+        logger.info('Сжато заметок: {0}'.format(compressed))
+        return compressed
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from time import sleep
+
+from bot import Telebot, parse_data
+from log_config import attach_to_queue, setup_logging
+from send_queue import SendQueue
+from offset_store import FileOffsetStore
+from start import (
+    ERROR_DELAY, OFFSET_FILE, SEND_WORKERS, TELEGRAM_API, create_storage,
+    execute_batch, get_commands, start_metrics_server
+)
+from write_buffer import WriteBuffer
+
+
+logger = logging.getLogger(__name__)
+
+
+# число процессов, выполняющих команды
+WORKERS = 4
+# размер пула соединений с базой в каждом процессе
+WORKER_DB_POOL_SIZE = 2
+# время жизни кэша тэгов в секундах: /write_tag выполняет один процесс,
+# остальные видят новое описание тэга не позже чем через это время
+WORKER_TAG_CACHE_TTL = 30
+# максимальное число команд, которые рабочий процесс без подтверждений
+# (режим webhook) выполняет одним пакетом
+WORKER_BATCH = 100
+
+
+class CommandWorker:
+    """
+    Исполнитель команд внутри рабочего процесса.
+
+    Создается в рабочем процессе и владеет собственными соединениями
+    с базой данных и с API Telegram.
+    Имеет следующие публичные методы:
+    handle(commands) - выполнить пакет команд и поставить ответы
+                       в очередь; заметки пакета записываются одной
+                       транзакцией (см. start.execute_batch);
+    flush() - дождаться отправки всех ответов;
+    close() - освободить ресурсы.
+    """
+    def __init__(self):
+        self.bot = Telebot(os.environ.get('BOT_ID'), pool_size=SEND_WORKERS,
+                           **TELEGRAM_API)
+        self.conn = create_storage(WORKER_DB_POOL_SIZE, WORKER_TAG_CACHE_TTL)
+        self.commands = get_commands(self.conn, self.bot)
+        self.write_buffer = WriteBuffer(self.conn)
+        self.send_queue = SendQueue(self.bot, workers=SEND_WORKERS)
+        self.send_queue.start()
+
+    def handle(self, commands):
+        for user_id, reply in execute_batch(
+                self.commands, self.write_buffer, commands):
+            self.send_queue.put(user_id, reply)
+
+    def flush(self):
+        self.send_queue.join()
+
+    def close(self):
+        self.send_queue.stop()
+        self.conn.close_connection()
+        self.bot.close()
+
+
+def _worker_main(index, worker_factory, inbox, acks, log_queue):
+    # Ctrl+C останавливает только супервизор, рабочий процесс
+    # завершается после того, как доработает свою часть пакета
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if log_queue is not None:
+        attach_to_queue(log_queue)
+    # метрики процесса index доступны на порту METRICS_PORT + index + 1
+    start_metrics_server(index + 1)
+    worker = worker_factory()
+    stopping = False
+    try:
+        while not stopping:
+            message = inbox.get()
+            if message is None:
+                break
+            batch_id, commands = message
+            if acks is None:
+                # команды приходят по одной: накопившиеся в очереди
+                # выполняются одним пакетом
+                commands = list(commands)
+                while len(commands) < WORKER_BATCH:
+                    try:
+                        message = inbox.get_nowait()
+                    except queue.Empty:
+                        break
+                    if message is None:
+                        stopping = True
+                        break
+                    commands.extend(message[1])
+            try:
+                worker.handle(commands)
+            except Exception as err:
+                logger.error(err, exc_info=True)
+            if acks is not None:
+                worker.flush()
+                acks.put((batch_id, index))
+    finally:
+        worker.close()
+
+
+class WorkerPool:
+    """
+    Рабочие процессы, выполняющие команды пользователей.
+
+    При инициализации принимает фабрику исполнителя команд (вызывается
+    в каждом рабочем процессе, см. CommandWorker), число процессов,
+    очередь журнала (log_queue), размер входящей очереди каждого
+    процесса (queue_size, 0 - без ограничения) и флаг acks: сообщают
+    ли процессы о выполнении каждого пакета (см. Supervisor).
+    Команды распределяются по процессам по остатку от деления
+    user_id, поэтому команды одного пользователя выполняет один
+    процесс по порядку, и кэши его заметок находятся в одном процессе.
+    Имеет следующие публичные методы:
+    start() - запустить рабочие процессы;
+    shard(user_id) - вернуть номер процесса пользователя;
+    put(index, batch_id, commands) - передать пакет команд процессу;
+    submit(command) - передать команду процессу ее пользователя без
+                      подтверждения; если очередь процесса заполнена,
+                      ждет освобождения места;
+    is_alive(index) - работает ли процесс;
+    stop() - дождаться выполнения переданных команд и остановить
+             процессы.
+    """
+    def __init__(self, worker_factory=CommandWorker, workers=WORKERS,
+                 log_queue=None, queue_size=0, acks=True):
+        self.worker_factory = worker_factory
+        self.workers = workers
+        self.log_queue = log_queue
+        self.queue_size = queue_size
+        self.acks = multiprocessing.Queue() if acks else None
+        self.inboxes = []
+        self.processes = []
+
+    def start(self):
+        for index in range(self.workers):
+            inbox = multiprocessing.Queue(self.queue_size)
+            process = multiprocessing.Process(
+                target=_worker_main,
+                args=(index, self.worker_factory, inbox, self.acks,
+                      self.log_queue),
+                name='worker-{0}'.format(index),
+                daemon=True
+            )
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+
+    def shard(self, user_id):
+        return user_id % self.workers
+
+    def put(self, index, batch_id, commands):
+        self.inboxes[index].put((batch_id, commands))
+
+    def submit(self, command):
+        self.put(self.shard(command.user_id), None, [command])
+
+    def is_alive(self, index):
+        return self.processes[index].is_alive()
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+
+
+class ShutdownRequested(Exception):
+    """
+    Получен сигнал остановки во время ожидания новых обновлений.
+    """
+
+
+class Supervisor:
+    """
+    Распределяет команды между несколькими рабочими процессами.
+
+    При инициализации принимает экземпляр Telebot, фабрику исполнителя
+    команд (вызывается в каждом рабочем процессе, см. CommandWorker),
+    число рабочих процессов и очередь журнала (log_queue), настроенную
+    log_config.setup_logging(); рабочие процессы пишут журнал в нее,
+    и файл журнала ведет только этот процесс.
+    Один процесс получает обновления и отдает команды рабочим
+    процессам по остатку от деления user_id, поэтому команды одного
+    пользователя выполняются по порядку. Смещение getUpdates
+    подтверждается только после того, как все рабочие процессы
+    сообщили о выполнении своей части пакета.
+    Имеет следующие публичные методы:
+    run() - запустить рабочие процессы и обрабатывать обновления
+            до получения SIGINT или SIGTERM;
+    stop() - запросить остановку после текущего пакета.
+    """
+    def __init__(self, bot, worker_factory=CommandWorker, workers=WORKERS,
+                 log_queue=None):
+        bot.auto_commit = False
+        self.bot = bot
+        self.workers = workers
+        self.pool = WorkerPool(worker_factory, workers, log_queue)
+        self.batch_id = 0
+        self.stopping = False
+        self._interruptible = False
+
+    def _on_signal(self, signum, frame):
+        self.stopping = True
+        if self._interruptible:
+            raise ShutdownRequested()
+
+    def stop(self):
+        self.stopping = True
+
+    def dispatch(self, commands):
+        """
+        Раздает пакет команд рабочим процессам и ждет подтверждений.
+        """
+        self.batch_id += 1
+        shards = [[] for _ in range(self.workers)]
+        for command in commands:
+            shards[self.pool.shard(command.user_id)].append(command)
+        for index, shard in enumerate(shards):
+            self.pool.put(index, self.batch_id, shard)
+        pending = set(range(self.workers))
+        while pending:
+            try:
+                batch_id, index = self.pool.acks.get(timeout=1)
+            except queue.Empty:
+                for index in pending:
+                    if not self.pool.is_alive(index):
+                        raise RuntimeError(
+                            'Рабочий процесс {0} завершился'.format(index))
+                continue
+            if batch_id == self.batch_id:
+                pending.discard(index)
+
+    def _interrupt_safely(self, func, *args):
+        # func можно прервать сигналом остановки: пока она выполняется,
+        # необработанных команд нет
+        self._interruptible = True
+        try:
+            if self.stopping:
+                raise ShutdownRequested()
+            return func(*args)
+        finally:
+            self._interruptible = False
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGTERM, self._on_signal)
+        self.pool.start()
+        try:
+            while not self.stopping:
+                try:
+                    data = self._interrupt_safely(self.bot.check_updates)
+                    if not data.get('ok'):
+                        self._interrupt_safely(sleep, ERROR_DELAY)
+                        continue
+                except ShutdownRequested:
+                    break
+                self.dispatch(parse_data(data))
+                self.bot.commit_offset()
+        finally:
+            self.pool.stop()
+            self._confirm_offset()
+            self.bot.close()
+
+    def _confirm_offset(self):
+        # Telegram считает обновления обработанными, когда получает
+        # запрос getUpdates со смещением больше их update_id
+        if self.bot.offset is None:
+            return
+        try:
+            self.bot.check_updates(timeout=0, limit=1)
+        except Exception as err:
+            logger.error(err, exc_info=True)
+
+
+def main():
+    log_queue = multiprocessing.Queue()
+    setup_logging(log_queue)
+    bot = Telebot(
+        os.environ.get('BOT_ID'),
+        pool_size=1,
+        offset_store=FileOffsetStore(OFFSET_FILE),
+        **TELEGRAM_API
+    )
+    start_metrics_server()
+    Supervisor(bot, log_queue=log_queue).run()
+
+if __name__ == '__main__':
+    main()
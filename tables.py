@@ -42,4 +42,80 @@ TABLES = [
         '    UNIQUE KEY message_tag (message_id, tag_id)'
         ');'
     )
+]
+
+
+# Миграции схемы: список пар (версия, список SQL-запросов).
+# Применяются по порядку функцией DbConnector.migrate() к базам, версия
+# схемы которых меньше версии миграции.
+MIGRATIONS = [
+    (
+        1,
+        [
+            # перед созданием уникального индекса объединяем тэги
+            # с одинаковыми именами: связи переносятся на тэг
+            # с наименьшим id, остальные тэги удаляются
+            (
+                'INSERT IGNORE INTO messages_tags (message_id, tag_id) '
+                'SELECT messages_tags.message_id, keep.id FROM messages_tags '
+                'JOIN tags ON tags.id = messages_tags.tag_id '
+                'JOIN (SELECT name, MIN(id) AS id FROM tags GROUP BY name) keep '
+                '    ON keep.name = tags.name AND keep.id <> tags.id;'
+            ),
+            (
+                'DELETE tags FROM tags '
+                'JOIN (SELECT name, MIN(id) AS id FROM tags GROUP BY name) keep '
+                '    ON keep.name = tags.name AND keep.id <> tags.id;'
+            ),
+            'CREATE UNIQUE INDEX tags_name ON tags (name);',
+            # read_all: заметки пользователя по возрастанию id
+            'CREATE INDEX messages_user_id ON messages (user_id, id);',
+            # read_tag: заметки по тэгу, покрывающий индекс связей
+            'CREATE INDEX messages_tags_tag_id ON messages_tags (tag_id, message_id);'
+        ]
+    ),
+    (
+        2,
+        [
+            # полнотекстовый поиск по заметкам (команда /search)
+            'CREATE FULLTEXT INDEX messages_text ON messages (text);'
+        ]
+    ),
+    (
+        3,
+        [
+            # id обновления Telegram: повторная обработка того же
+            # обновления после перезапуска не создает дубликат заметки
+            (
+                'ALTER TABLE messages '
+                'ADD COLUMN update_id BIGINT NULL, '
+                'ADD UNIQUE INDEX messages_update_id (update_id);'
+            )
+        ]
+    ),
+    (
+        4,
+        [
+            # сжатые заметки: текст хранится в body, compression -
+            # метод сжатия (0 - без сжатия, см. note_compression)
+            (
+                'ALTER TABLE messages '
+                'ADD COLUMN body BLOB NULL, '
+                'ADD COLUMN compression TINYINT NOT NULL DEFAULT 0;'
+            )
+        ]
+    ),
+    (
+        5,
+        [
+            # временный ключ заметок без update_id (импорт архива):
+            # по нему находятся id строк многострочного INSERT, после
+            # чего ключ сбрасывается в NULL
+            (
+                'ALTER TABLE messages '
+                'ADD COLUMN import_key BIGINT NULL, '
+                'ADD UNIQUE INDEX messages_import_key (import_key);'
+            )
+        ]
+    )
 ]
\ No newline at end of file
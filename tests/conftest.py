@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlite_storage import SqliteStorage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    # база SQLite во временном каталоге: тестам не нужен сервер MySQL
+    storage = SqliteStorage(str(tmp_path / 'notes.db'))
+    storage.create_tables()
+    storage.migrate()
+    yield storage
+    storage.close_connection()
@@ -0,0 +1,75 @@
+from bot import MAX_MESSAGE_LENGTH, build_replies, parse_data
+
+
+def update(update_id, text, user_id=1):
+    return {
+        'update_id': update_id,
+        'message': {
+            'date': 1625140800,
+            'from': {'id': user_id},
+            'text': text
+        }
+    }
+
+
+def test_parse_data_commands():
+    commands = parse_data({'ok': True, 'result': [
+        update(1, u'/write купить молоко #дом'),
+        update(2, u'/read_tag дом 2', user_id=5)
+    ]})
+    assert [command.text for command in commands] == ['write', 'read_tag']
+    write, read_tag = commands
+    assert write.user_id == 1
+    assert write.update_id == 1
+    assert write.params['text'] == u'купить молоко #дом'
+    assert write.params['tags_names'] == [u'дом']
+    assert write.params['update_id'] == 1
+    assert read_tag.params == {'user_id': 5, 'tag_name': u'дом', 'page': 2}
+
+
+def test_parse_data_skips_bad_updates():
+    commands = parse_data({'ok': True, 'result': [
+        update(1, u'/read не_число'),
+        {'update_id': 2, 'message': {'text': u'/read_last'}},
+        {'update_id': 3, 'message': {'from': {'id': 1}, 'text': None}},
+        update(4, u'/write_tag без_определения'),
+        update(5, u'/unknown'),
+        update(6, u'просто текст'),
+        {'update_id': 7, 'edited_message': {}},
+        update(8, u'/read 3')
+    ]})
+    assert [(command.update_id, command.params) for command in commands] == [
+        (8, {'user_id': 1, 'message_id': 3})]
+
+
+def test_parse_data_failed_response():
+    assert parse_data({'ok': False, 'result': [update(1, u'/read 3')]}) == []
+    assert parse_data({'ok': True}) == []
+
+
+def test_build_replies_packs_lines():
+    lines = [u'а' * 2000, u'б' * 2000, u'в' * 95, u'г' * 10]
+    replies = list(build_replies(lines))
+    # 2000 + 1 + 2000 + 1 + 95 = 4097 не помещается в одно сообщение
+    assert replies == [u'а' * 2000 + u'\n' + u'б' * 2000,
+                       u'в' * 95 + u'\n' + u'г' * 10]
+    assert list(build_replies([u'а' * 2000, u'б' * 2095])) == [
+        u'а' * 2000 + u'\n' + u'б' * 2095]
+
+
+def test_build_replies_splits_long_line():
+    long_line = u'д' * (2 * MAX_MESSAGE_LENGTH + 10)
+    replies = list(build_replies([u'начало', long_line, u'конец']))
+    assert replies == [u'начало',
+                       u'д' * MAX_MESSAGE_LENGTH,
+                       u'д' * MAX_MESSAGE_LENGTH,
+                       u'д' * 10,
+                       u'конец']
+    assert all(len(reply) <= MAX_MESSAGE_LENGTH for reply in replies)
+
+
+def test_build_replies_string_and_empty():
+    assert list(build_replies(u'одна строка')) == [u'одна строка']
+    assert list(build_replies([])) == []
+    assert list(build_replies([u'а', u'б'], limit=3)) == [u'а\nб']
+    assert list(build_replies([u'а', u'б'], limit=2)) == [u'а', u'б']
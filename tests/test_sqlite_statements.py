@@ -0,0 +1,58 @@
+import sqlite3
+
+from sqlite_storage import sqlite_statements
+from tables import MIGRATIONS, TABLES
+
+
+def test_create_table_translation():
+    messages, = sqlite_statements(TABLES[1])
+    assert 'id INTEGER PRIMARY KEY AUTOINCREMENT' in messages
+    assert 'UNSIGNED' not in messages
+    assert not messages.endswith(';')
+    tags, = sqlite_statements(TABLES[3])
+    assert 'name VARCHAR(50) COLLATE NOCASE NOT NULL' in tags
+    messages_tags, = sqlite_statements(TABLES[4])
+    assert 'UNIQUE (message_id, tag_id)' in messages_tags
+    assert 'UNIQUE KEY' not in messages_tags
+
+
+def test_mysql_only_statements_are_skipped():
+    # внешний ключ к существующей таблице
+    assert sqlite_statements(TABLES[2]) == []
+    # многотабличный DELETE и полнотекстовый индекс
+    assert sqlite_statements(MIGRATIONS[0][1][1]) == []
+    assert sqlite_statements(MIGRATIONS[1][1][0]) == []
+
+
+def test_insert_ignore_translation():
+    insert, = sqlite_statements(MIGRATIONS[0][1][0])
+    assert insert.startswith('INSERT OR IGNORE INTO messages_tags')
+
+
+def test_alter_table_is_split():
+    assert sqlite_statements(MIGRATIONS[2][1][0]) == [
+        'ALTER TABLE messages ADD COLUMN update_id BIGINT NULL',
+        'CREATE UNIQUE INDEX messages_update_id ON messages (update_id)'
+    ]
+    assert sqlite_statements(MIGRATIONS[3][1][0]) == [
+        'ALTER TABLE messages ADD COLUMN body BLOB NULL',
+        'ALTER TABLE messages '
+        'ADD COLUMN compression TINYINT NOT NULL DEFAULT 0'
+    ]
+
+
+def test_schema_applies_to_sqlite():
+    cnx = sqlite3.connect(':memory:')
+    statements = list(TABLES)
+    for _, migration in MIGRATIONS:
+        statements.extend(migration)
+    for statement in statements:
+        for translated in sqlite_statements(statement):
+            cnx.execute(translated)
+    columns = [row[1] for row in cnx.execute('PRAGMA table_info(messages);')]
+    assert columns == ['id', 'date', 'text', 'user_id', 'update_id', 'body',
+                       'compression', 'import_key']
+    indexes = set(row[1] for row in cnx.execute('PRAGMA index_list(messages);'))
+    assert {'messages_user_id', 'messages_update_id',
+            'messages_import_key'} <= indexes
+    cnx.close()
@@ -0,0 +1,136 @@
+import datetime
+
+from sqlite_storage import SqliteStorage
+
+
+DATE = datetime.datetime(2021, 7, 1, 12, 0, 0)
+USER_ID = 1
+OTHER_USER_ID = 2
+
+
+def note(text, update_id=None, user_id=USER_ID, tags_names=()):
+    return {
+        'date': DATE,
+        'text': text,
+        'user_id': user_id,
+        'tags_names': list(tags_names),
+        'update_id': update_id
+    }
+
+
+def count_messages(storage):
+    with storage._connection() as cnx:
+        return cnx.execute('SELECT count(*) FROM messages;').fetchone()[0]
+
+
+def reopen(storage):
+    # новое хранилище на той же базе: пустые кэши, чтение идет из базы
+    return SqliteStorage(storage.path)
+
+
+def test_write_read_round_trip(storage):
+    storage.add_user(USER_ID, DATE)
+    reply = storage.write(DATE, u'первая заметка', USER_ID, [])
+    message_id = int(reply.split()[1])
+    assert reply == u'заметка {0} сохранена'.format(message_id)
+    storage.write(DATE, u'вторая заметка', USER_ID, [])
+
+    fresh = reopen(storage)
+    assert fresh.read(USER_ID, message_id) == u'первая заметка'
+    assert fresh.read_last(USER_ID) == u'вторая заметка'
+    assert list(fresh.read_all(USER_ID)) == [
+        u'первая заметка', u'вторая заметка']
+    assert fresh.read(OTHER_USER_ID, message_id) == (
+        u'заметка {0} принадлежит другому пользователю'.format(message_id))
+    assert fresh.read(USER_ID, message_id + 100) == (
+        u'заметка {0} не найдена'.format(message_id + 100))
+    fresh.close_connection()
+
+
+def test_read_all_pages(storage):
+    storage.add_user(USER_ID, DATE)
+    storage.write_many([note(u'заметка {0}'.format(number))
+                        for number in range(5)])
+    assert storage.read_all(USER_ID, page=2, page_size=2) == [
+        u'заметка 2', u'заметка 3']
+    assert list(storage.read_all(USER_ID, page_size=2)) == [
+        u'заметка {0}'.format(number) for number in range(5)]
+
+
+def test_read_tag_round_trip(storage):
+    storage.add_user(USER_ID, DATE)
+    storage.write_tag(u'работа', u'заметки о работе')
+    storage.write(DATE, u'отчет #работа', USER_ID, [u'работа'])
+    storage.write(DATE, u'без тэга', USER_ID, [])
+    # имя тэга сравнивается без учета регистра, как в MySQL
+    storage.write(DATE, u'план #Работа', USER_ID, [u'Работа'])
+
+    fresh = reopen(storage)
+    assert list(fresh.read_tag(USER_ID, u'работа')) == [
+        u'отчет #работа', u'план #Работа']
+    assert list(fresh.read_tag(USER_ID, u'РАБОТА')) == [
+        u'отчет #работа', u'план #Работа']
+    assert list(fresh.read_tag(OTHER_USER_ID, u'работа')) == []
+    assert fresh.read_tag(USER_ID, u'отдых') == []
+    assert fresh.tag([u'работа']) == [u'#работа - заметки о работе']
+    fresh.close_connection()
+
+
+def test_search_round_trip(storage):
+    storage.add_user(USER_ID, DATE)
+    storage.add_user(OTHER_USER_ID, DATE)
+    storage.write(DATE, u'купить молоко', USER_ID, [])
+    storage.write(DATE, u'позвонить маме', USER_ID, [])
+    storage.write(DATE, u'купить хлеб', OTHER_USER_ID, [])
+
+    results = storage.search(USER_ID, u'молоко')
+    assert len(results) == 1
+    assert results[0].endswith(u': купить молоко')
+    # заметки других пользователей в поиск не попадают
+    assert [result.split(': ', 1)[1]
+            for result in storage.search(USER_ID, u'купить')] == [
+                u'купить молоко']
+    assert storage.search(USER_ID, u'  ') == []
+    # индекс в памяти дополняется новыми заметками
+    storage.write(DATE, u'молоко и сыр', USER_ID, [])
+    assert len(storage.search(USER_ID, u'молоко')) == 2
+
+
+def test_replayed_update_id(storage):
+    storage.add_user(USER_ID, DATE)
+    first = storage.write(DATE, u'заметка', USER_ID, [], update_id=10)
+    # повторная обработка того же обновления после перезапуска
+    assert storage.write(DATE, u'заметка', USER_ID, [], update_id=10) == first
+    assert reopen(storage).write(
+        DATE, u'заметка', USER_ID, [], update_id=10) == first
+    assert count_messages(storage) == 1
+
+
+def test_duplicate_update_id_in_batch(storage):
+    storage.add_user(USER_ID, DATE)
+    replies = storage.write_many([
+        note(u'первая', update_id=20),
+        note(u'вторая', update_id=21),
+        note(u'первая, повтор', update_id=20)
+    ])
+    assert replies[0] == replies[2]
+    assert replies[0] != replies[1]
+    assert count_messages(storage) == 2
+    # сохраняется первая копия обновления
+    message_id = int(replies[0].split()[1])
+    assert reopen(storage).read(USER_ID, message_id) == u'первая'
+    assert storage.read_last(USER_ID) == u'вторая'
+
+
+def test_replayed_import(storage):
+    storage.add_user(USER_ID, DATE)
+    tags = [(u'дом', u'домашние дела')]
+    notes = [{'date': DATE, 'text': u'заметка {0} #дом'.format(number),
+              'tags': [u'дом']} for number in range(3)]
+    assert storage.import_notes(USER_ID, tags, notes, batch_size=2,
+                                update_id=30) == 3
+    storage.import_notes(USER_ID, tags, notes, batch_size=2, update_id=30)
+    assert count_messages(storage) == 3
+    assert len(list(storage.read_tag(USER_ID, u'дом'))) == 3
+    # импорт не меняет последнюю заметку пользователя
+    assert storage.read_last(USER_ID) == u''
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import io
+import json
+import logging
+import queue
+import socket
+import ssl
+import threading
+from urllib.parse import quote
+
+
+logger = logging.getLogger(__name__)
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decode_json(body):
+    """
+    Декодирует JSON непосредственно из байтов тела ответа.
+
+    Если установлен orjson, используется он.
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def encode_query(params):
+    """
+    Кодирует словарь параметров в строку запроса URL.
+
+    Значения экранируются целиком (включая '#', '&', '/' и перевод
+    строки), поэтому хранилище и команды возвращают текст как есть,
+    а экранирование выполняется один раз перед отправкой.
+    """
+    return '&'.join('{0}={1}'.format(key, quote(str(value), safe=''))
+                    for key, value in params.items())
+
+
+# размер блока, которым файл из тела запроса передается в сокет
+SEND_CHUNK = 65536
+
+
+def body_length(body):
+    """
+    Возвращает длину тела запроса: байтов или списка частей, каждая из
+    которых - байты или двоичный файл с произвольным доступом.
+    """
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    if isinstance(body, (list, tuple)):
+        return sum(body_length(part) for part in body)
+    body.seek(0, io.SEEK_END)
+    return body.tell()
+
+
+def build_request(host, method, path, body=None, headers=None):
+    """
+    Возвращает байты HTTP/1.1 запроса с заголовками и телом body,
+    если оно задано байтами (части-файлы передаются отдельно).
+    """
+    lines = [
+        '{0} {1} HTTP/1.1'.format(method, path),
+        'Host: {0}'.format(host),
+        'Connection: keep-alive'
+    ]
+    if headers:
+        lines.extend('{0}: {1}'.format(*item) for item in headers.items())
+    if body is not None:
+        lines.append('Content-Length: {0}'.format(body_length(body)))
+    raw = ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+    if isinstance(body, (bytes, bytearray)):
+        raw += body
+    return raw
+
+
+class StaleConnection(Exception):
+    """
+    Соединение было закрыто сервером до получения ответа.
+    """
+
+
+class Response:
+    """
+    Ответ HTTP-сервера.
+
+    Содержит следующие аттрибуты:
+    status - код ответа (int);
+    reason - текстовое описание кода ответа;
+    headers - словарь заголовков (имена в нижнем регистре);
+    body - тело ответа (bytes или bytearray).
+    """
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        return self.headers.get('connection', '').lower() != 'close'
+
+
+class SocketReader:
+    """
+    Буферизованное чтение HTTP-ответа из сокета.
+
+    Заголовки читаются в общий буфер, а тело ответа известной длины
+    принимается через recv_into прямо в заранее выделенный bytearray,
+    без промежуточных копий.
+    """
+    def __init__(self, sock, buffer_size=65536):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    def _fill(self):
+        data = self.sock.recv(self.buffer_size)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def read_until(self, delimiter):
+        start = 0
+        while True:
+            pos = self.buffer.find(delimiter, start)
+            if pos != -1:
+                end = pos + len(delimiter)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            if not self._fill():
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return data
+
+    def read_exact(self, length):
+        body = bytearray(length)
+        view = memoryview(body)
+        pos = min(length, len(self.buffer))
+        view[:pos] = self.buffer[:pos]
+        del self.buffer[:pos]
+        while pos < length:
+            received = self.sock.recv_into(view[pos:])
+            if not received:
+                raise socket.error('Неполный ответ сервера')
+            pos += received
+        return body
+
+    def read_all(self):
+        while self._fill():
+            pass
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def parse_head(head):
+    """
+    Разбирает строку статуса и заголовки ответа, заданные байтами.
+
+    Возвращает кортеж (код ответа, описание, словарь заголовков).
+    """
+    lines = head.rstrip(b'\r\n').split(b'\r\n')
+    status = (lines[0].split(b' ', 2) + [b''])[:3]
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower().decode('latin-1')] = (
+            value.strip().decode('latin-1'))
+    return int(status[1]), status[2].decode('latin-1'), headers
+
+
+class HttpConnection:
+    """
+    Одно постоянное (keep-alive) HTTP/1.1 соединение с сервером.
+
+    Ответ читается строго по Content-Length или по chunked-кодированию,
+    поэтому соединение можно использовать повторно.
+    """
+    def __init__(self, host, port, use_tls=True, timeout=None):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+        self.requests_served = 0
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.use_tls:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=self.host)
+        self.sock = sock
+        self.reader = SocketReader(sock)
+        self.requests_served = 0
+
+    def close(self):
+        self.reader = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _send_part(self, part):
+        if isinstance(part, (bytes, bytearray)):
+            self.sock.sendall(part)
+            return
+        # файл передается блоками и не загружается в память целиком
+        part.seek(0)
+        while True:
+            chunk = part.read(SEND_CHUNK)
+            if not chunk:
+                break
+            self.sock.sendall(chunk)
+
+    def request(self, raw_request, timeout=None, body_parts=()):
+        if self.sock is None:
+            self.connect()
+        self.sock.settimeout(timeout if timeout is not None else self.timeout)
+        reused = self.requests_served > 0
+        try:
+            self.sock.sendall(raw_request)
+            for part in body_parts:
+                self._send_part(part)
+            head = self.reader.read_until(b'\r\n\r\n')
+        except (socket.error, ssl.SSLError):
+            self.close()
+            if reused:
+                raise StaleConnection()
+            raise
+        if not head:
+            self.close()
+            if reused:
+                raise StaleConnection()
+            raise socket.error('Соединение закрыто сервером')
+        response = self._read_response(head)
+        self.requests_served += 1
+        if not response.keep_alive:
+            self.close()
+        return response
+
+    def _read_response(self, head):
+        status, reason, headers = parse_head(head)
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = self._read_chunked()
+        elif 'content-length' in headers:
+            body = self.reader.read_exact(int(headers['content-length']))
+        else:
+            body = self.reader.read_all()
+            headers['connection'] = 'close'
+        return Response(status, reason, headers, body)
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size_line = self.reader.read_until(b'\r\n')
+            size = int(size_line.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                while self.reader.read_until(b'\r\n') not in (b'\r\n', b''):
+                    pass
+                break
+            chunks.append(self.reader.read_exact(size))
+            self.reader.read_until(b'\r\n')
+        return b''.join(chunks)
+
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений с одним хостом.
+
+    При инициализации принимает имя хоста, порт, размер пула, флаг
+    использования TLS и таймаут сокета.
+    Имеет следующие публичные методы:
+    request(method, path, body, headers, timeout) - выполнить запрос
+                                                    на свободном
+                                                    соединении и
+                                                    вернуть экземпляр
+                                                    Response;
+    close() - закрыть все соединения пула.
+    Если соединение из пула оказалось закрыто сервером, запрос
+    автоматически повторяется на новом соединении.
+    Тело запроса body - байты или список частей (байты или двоичные
+    файлы, см. body_length); файлы передаются в сокет блоками, поэтому
+    большой документ можно отправить, не читая его в память.
+    """
+    def __init__(self, host, port, size=4, use_tls=True, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return HttpConnection(
+                self.host, self.port, self.use_tls, self.timeout)
+
+    def _checkin(self, conn):
+        if conn.sock is not None:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        raw_request = build_request(self.host, method, path, body, headers)
+        body_parts = body if isinstance(body, (list, tuple)) else ()
+        conn = self._checkout()
+        try:
+            try:
+                return conn.request(raw_request, timeout, body_parts)
+            except StaleConnection:
+                logger.info('Соединение с {0} устарело, переподключение'.format(
+                    self.host))
+                return conn.request(raw_request, timeout, body_parts)
+        except Exception:
+            conn.close()
+            raise
+        finally:
+            self._checkin(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class AsyncHttpConnection:
+    """
+    Постоянное HTTP/1.1 соединение поверх asyncio-потоков.
+    """
+    def __init__(self, host, port, use_tls=True):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.reader = None
+        self.writer = None
+        self.requests_served = 0
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_tls else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port, ssl=context,
+            server_hostname=self.host if self.use_tls else None)
+        self.requests_served = 0
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.reader = None
+
+    async def request(self, raw_request):
+        if self.writer is None:
+            await self.connect()
+        reused = self.requests_served > 0
+        try:
+            self.writer.write(raw_request)
+            await self.writer.drain()
+            status_line = await self.reader.readline()
+        except (OSError, ssl.SSLError):
+            self.close()
+            if reused:
+                raise StaleConnection()
+            raise
+        if not status_line:
+            self.close()
+            if reused:
+                raise StaleConnection()
+            raise socket.error('Соединение закрыто сервером')
+        response = await self._read_response(status_line)
+        self.requests_served += 1
+        if not response.keep_alive:
+            self.close()
+        return response
+
+    async def _read_response(self, status_line):
+        version, status, reason = (
+            status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = await self.reader.readline()
+                size = int(size_line.split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    while await self.reader.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            body = await self.reader.read()
+            headers['connection'] = 'close'
+        return Response(int(status), reason, headers, body)
+
+
+class AsyncConnectionPool:
+    """
+    Асинхронный вариант ConnectionPool для работы внутри asyncio.
+
+    Интерфейс совпадает с ConnectionPool, но метод request является
+    корутиной, а тело запроса может быть только байтами.
+    """
+    def __init__(self, host, port, size=4, use_tls=True, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._idle = []
+        self._slots = None
+
+    def _get_slots(self):
+        # семафор создается лениво, внутри работающего цикла событий
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.size)
+        return self._slots
+
+    async def request(self, method, path, body=None, headers=None, timeout=None):
+        if body is not None and not isinstance(body, (bytes, bytearray)):
+            raise TypeError('тело асинхронного запроса должно быть байтами')
+        raw_request = build_request(self.host, method, path, body, headers)
+        if timeout is None:
+            timeout = self.timeout
+        async with self._get_slots():
+            if self._idle:
+                conn = self._idle.pop()
+            else:
+                conn = AsyncHttpConnection(self.host, self.port, self.use_tls)
+            try:
+                try:
+                    response = await asyncio.wait_for(
+                        conn.request(raw_request), timeout)
+                except StaleConnection:
+                    logger.info(
+                        'Соединение с {0} устарело, переподключение'.format(
+                            self.host))
+                    response = await asyncio.wait_for(
+                        conn.request(raw_request), timeout)
+            except BaseException:
+                conn.close()
+                raise
+            if conn.writer is not None:
+                self._idle.append(conn)
+            return response
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
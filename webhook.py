@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import logging
+import queue
+import ssl
+import sys
+import threading
+
+from bot import parse_data
+from transport import decode_json
+
+
+logger = logging.getLogger(__name__)
+
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# максимальный размер тела запроса с обновлением в байтах
+MAX_BODY_BYTES = 1024 * 1024
+# таймаут сокета соединения (включая TLS handshake) в секундах
+CONNECTION_TIMEOUT = 30
+
+
+class _HttpServer(ThreadingHTTPServer):
+    daemon_threads = True
+    ssl_context = None
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self.ssl_context is not None:
+            # handshake выполняется в потоке обработчика (см. setup),
+            # чтобы медленный клиент не задерживал прием соединений
+            sock = self.ssl_context.wrap_socket(
+                sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def handle_error(self, request, client_address):
+        # обрыв соединения или неудачный handshake - ошибка клиента,
+        # трассировка нужна только для остальных исключений
+        err = sys.exc_info()[1]
+        logger.warning('Ошибка соединения webhook с %s: %s',
+                       client_address[0], err,
+                       exc_info=not isinstance(err, OSError))
+
+
+class WebhookServer:
+    """
+    HTTP(S)-сервер, принимающий обновления Telegram в режиме webhook.
+
+    При инициализации принимает:
+    -handler - функцию handler(command), выполняющую одну команду
+               или передающую ее рабочему процессу (см.
+               supervisor.WorkerPool.submit);
+    -host, port - адрес, на котором слушает сервер;
+    -path - путь, на который Telegram отправляет обновления;
+    -secret_token - секрет, который Telegram передает в заголовке
+                    X-Telegram-Bot-Api-Secret-Token;
+    -workers - число потоков, выполняющих команды;
+    -queue_size - размер очереди каждого потока; если очередь
+                  заполнена, сервер отвечает 503 и Telegram повторит
+                  доставку позже;
+    -certfile, keyfile - сертификат и ключ для HTTPS (опционально);
+                         TLS handshake выполняется в потоке
+                         обработчика соединения.
+    Команды одного пользователя всегда попадают в один поток и
+    выполняются по порядку. Путь и секрет проверяются до чтения тела
+    запроса; тело больше MAX_BODY_BYTES отклоняется с кодом 413.
+    Имеет следующие публичные методы:
+    start() - запустить потоки обработки команд;
+    serve_forever() - принимать обновления до вызова stop();
+    stop() - остановить сервер и дождаться выполнения принятых команд.
+    """
+    def __init__(self, handler, host='0.0.0.0', port=8443, path='/',
+                 secret_token=None, workers=4, queue_size=1000,
+                 certfile=None, keyfile=None):
+        self.handler = handler
+        self.path = path
+        self.secret_token = secret_token
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self._threads = []
+        self.server = _HttpServer((host, port), self._request_handler())
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.server.ssl_context = context
+
+    def _request_handler(self):
+        webhook = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+            timeout = CONNECTION_TIMEOUT
+
+            def setup(self):
+                self.request.settimeout(self.timeout)
+                if isinstance(self.request, ssl.SSLSocket):
+                    self.request.do_handshake()
+                super().setup()
+
+            def do_POST(self):
+                # путь и секрет проверяются по заголовкам, до чтения
+                # тела запроса
+                status = webhook.check(
+                    self.path, self.headers.get(SECRET_HEADER))
+                if status is None:
+                    status = self._content_length_status()
+                if status is not None:
+                    # непрочитанное тело не позволяет продолжить
+                    # соединение
+                    self.close_connection = True
+                    self._reply(status)
+                    return
+                length = int(self.headers['Content-Length'])
+                self._reply(webhook.receive(self.rfile.read(length)))
+
+            def _content_length_status(self):
+                length = self.headers.get('Content-Length')
+                if length is None:
+                    return 411
+                if not length.isdigit():
+                    return 400
+                if int(length) > MAX_BODY_BYTES:
+                    return 413
+                return None
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return RequestHandler
+
+    def check(self, path, secret_token):
+        """
+        Проверяет путь и секрет запроса.
+
+        Возвращает HTTP-код отказа или None, если запрос можно принять.
+        """
+        if path != self.path:
+            return 404
+        if self.secret_token and not hmac.compare_digest(
+                (secret_token or '').encode('utf-8'),
+                self.secret_token.encode('utf-8')):
+            logger.warning('Запрос webhook с неверным секретом')
+            return 403
+        return None
+
+    def receive(self, body):
+        """
+        Разбирает тело проверенного запроса и ставит команду в очередь.
+
+        Возвращает HTTP-код ответа для Telegram.
+        """
+        try:
+            update = decode_json(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict):
+            return 400
+        for command in parse_data({'ok': True, 'result': [update]}):
+            worker_queue = self.queues[hash(command.user_id) % len(self.queues)]
+            try:
+                worker_queue.put_nowait(command)
+            except queue.Full:
+                logger.warning('Очередь команд заполнена')
+                return 503
+        return 200
+
+    def _worker(self, worker_queue):
+        while True:
+            command = worker_queue.get()
+            if command is None:
+                break
+            try:
+                self.handler(command)
+            except Exception as err:
+                logger.error(err, exc_info=True)
+
+    def start(self):
+        for worker_queue in self.queues:
+            thread = threading.Thread(
+                target=self._worker, args=(worker_queue,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
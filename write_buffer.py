@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import Future
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBuffer:
+    """
+    Буфер отложенной записи заметок (write-behind).
+
+    При инициализации принимает хранилище заметок (StorageBackend) и
+    параметры:
+    -max_batch - максимальное число заметок в одной транзакции;
+    -max_delay - максимальное время в секундах, которое заметка ждет
+                 в буфере, если запущен фоновый поток (start()).
+    Заметки из буфера записываются одной транзакцией с многострочными
+    INSERT (StorageBackend.write_many), поэтому на пакет заметок
+    приходится одна запись журнала транзакций на диск вместо одной
+    на каждую заметку. Если запись пакета не удалась, его заметки
+    записываются по одной, и ошибку получает только заметка, которую
+    нельзя сохранить.
+    Имеет следующие публичные методы:
+    submit(**params) - поставить заметку в буфер (параметры как у
+                       StorageBackend.write); возвращает Future, результатом
+                       которого будет уведомление о сохранении с id
+                       заметки;
+    flush() - немедленно записать все заметки из буфера;
+    start() - запустить фоновый поток, записывающий буфер не реже
+              чем раз в max_delay секунд;
+    stop() - записать оставшиеся заметки и остановить фоновый поток.
+    """
+    def __init__(self, conn, max_batch=100, max_delay=0.05):
+        self.conn = conn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def submit(self, date, text, user_id, tags_names, update_id=None):
+        future = Future()
+        note = {
+            'date': date,
+            'text': text,
+            'user_id': user_id,
+            'tags_names': tags_names,
+            'update_id': update_id
+        }
+        with self._lock:
+            self._pending.append((note, future))
+            full = len(self._pending) >= self.max_batch
+        if full:
+            if self._thread is None:
+                self.flush()
+            else:
+                self._wakeup.set()
+        return future
+
+    def flush(self):
+        # записи выполняются по очереди, чтобы заметки одного
+        # пользователя сохранялись в порядке поступления
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = self._pending[:self.max_batch]
+                    del self._pending[:self.max_batch]
+                if not batch:
+                    return
+                try:
+                    replies = self.conn.write_many(
+                        [note for note, _ in batch])
+                except Exception as err:
+                    logger.warning(
+                        'Пакет из %s заметок не записан (%s), запись по одной',
+                        len(batch), err)
+                    self._write_each(batch)
+                    continue
+                for (_, future), reply in zip(batch, replies):
+                    future.set_result(reply)
+
+    def _write_each(self, batch):
+        for note, future in batch:
+            try:
+                reply = self.conn.write_many([note])[0]
+            except Exception as err:
+                logger.error(err, exc_info=True)
+                future.set_exception(err)
+                continue
+            future.set_result(reply)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.max_delay)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._wakeup.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()